@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Cleans the HTML parts of a corpus with every cleaning profile, and the way it used to be done, and reports the
+cost per message.
+
+    python benchmarks/bench_html_cleaning.py newsletters.mbox saved_html/ --rounds 3
+
+The corpus is any mix of mbox files, .eml and .html files, and directories of those.
+"""
+
+import argparse
+import email
+import mailbox
+import os
+import sys
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import cutepiesmtpdaemon_py3 as gui
+from lxml.html.clean import Cleaner
+
+
+def html_parts(message):
+    for part in message.walk():
+        if part.get_content_type() == 'text/html':
+            payload = part.get_payload(decode=True)
+            if payload:
+                yield payload, part.get_content_charset()
+
+
+def load_corpus(paths):
+    """
+    :return: list of messages, each a list of (HTML bytes, charset or None)
+    """
+    corpus = []
+    for path in paths:
+        if os.path.isdir(path):
+            corpus.extend(load_corpus(sorted(os.path.join(path, name) for name in os.listdir(path))))
+        elif path.endswith('.html') or path.endswith('.htm'):
+            with open(path, 'rb') as html_file:
+                corpus.append([(html_file.read(), None)])
+        elif path.endswith('.eml'):
+            with open(path, 'rb') as eml_file:
+                corpus.append(list(html_parts(email.message_from_binary_file(eml_file))))
+        else:
+            corpus.extend(list(html_parts(message)) for message in mailbox.mbox(path))
+    return [parts for parts in corpus if parts]
+
+
+def clean_as_before(payload, charset):
+    """
+    What decode_part() used to do: decode, build a Cleaner, encode again, clean, decode the result
+    """
+    text = str(payload, encoding=charset or 'utf-8', errors='ignore')
+    cleaner = Cleaner(page_structure=False, links=False, style=True, scripts=True, frames=True)
+    return str(cleaner.clean_html(text.encode('utf-8')), 'utf-8', errors='ignore')
+
+
+def time_corpus(corpus, clean, rounds):
+    best = None
+    for __ in range(rounds):
+        start = time()
+        for parts in corpus:
+            for payload, charset in parts:
+                clean(payload, charset)
+        elapsed = time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('corpus', nargs='+', help='mbox, .eml or .html files, or directories of those')
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    if not corpus:
+        parser.error('no HTML parts found')
+    total_bytes = sum(len(payload) for parts in corpus for payload, __ in parts)
+    print('%d messages, %d HTML parts, %.1f MB of HTML' % (
+        len(corpus), sum(len(parts) for parts in corpus), total_bytes / 1e6))
+
+    cleaner = gui.HtmlCleaner()
+    runs = [('before', clean_as_before)]
+    for profile in sorted(gui.CLEANING_PROFILES):
+        runs.append((profile, lambda payload, charset, profile=profile: cleaner.clean(payload, charset, profile)))
+
+    for name, clean in runs:
+        elapsed = time_corpus(corpus, clean, args.rounds)
+        print('%-10s %8.3fs %10.3f ms/msg %8.2f MB/s' % (name, elapsed, elapsed * 1000 / len(corpus),
+                                                         total_bytes / elapsed / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Indexes a mailbox serially and with 1, 2, 4 and 8 scan processes, and reports the speedup over the serial scan.
+
+    python benchmarks/bench_mbox_load.py captured.mbox --rounds 3
+"""
+
+import argparse
+import mailbox
+import os
+import sys
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import smtp_mailsink as daemon
+
+
+def time_serial(mbox_path):
+    start = time()
+    count = sum(1 for __ in daemon.scan_mbox(mbox_path))
+    return time() - start, count
+
+
+def time_parallel(mbox_path, workers):
+    start = time()
+    count = sum(1 for __ in daemon.scan_mbox_parallel(mbox_path, workers=workers))
+    return time() - start, count
+
+
+def time_mailbox_module(mbox_path):
+    """
+    What opening a mailbox used to cost: every message parsed completely
+    """
+    start = time()
+    count = sum(1 for __ in mailbox.mbox(mbox_path))
+    return time() - start, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('mbox', help='mailbox to index')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--with-mailbox-module', action='store_true',
+                        help='also time a full parse with the mailbox module')
+    args = parser.parse_args()
+
+    # always split, so that small sample mailboxes show the scaling too
+    daemon.PARALLEL_SCAN_MIN_BYTES = 0
+
+    size = os.path.getsize(args.mbox)
+    serial, count = min(time_serial(args.mbox) for __ in range(args.rounds))
+    print('%d messages, %.1f MB, %d CPUs' % (count, size / 1e6, os.cpu_count() or 1))
+    print('%-16s %8.3fs %10.1f msg/s %8.2fx' % ('serial', serial, count / serial, 1.0))
+
+    for workers in args.workers:
+        elapsed, parallel_count = min(time_parallel(args.mbox, workers) for __ in range(args.rounds))
+        if parallel_count != count:
+            print('%d workers found %d messages instead of %d!' % (workers, parallel_count, count))
+        print('%-16s %8.3fs %10.1f msg/s %8.2fx' % ('%d workers' % workers, elapsed, count / elapsed,
+                                                    serial / elapsed))
+
+    if args.with_mailbox_module:
+        elapsed, __ = time_mailbox_module(args.mbox)
+        print('%-16s %8.3fs %10.1f msg/s %8.2fx' % ('mailbox module', elapsed, count / elapsed, serial / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Appends synthetic messages to a scratch mbox with every durability policy, and with the old
+open/append/close per message, and reports the append rate.
+
+    python benchmarks/bench_mbox_writer.py --messages 20000 --size 4096 --threads 8
+"""
+
+import argparse
+import io
+import os
+import sys
+import tempfile
+import threading
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import smtp_mailsink as daemon
+
+
+def make_message(size):
+    headers = b"From: bench@localhost\nTo: sink@localhost\nSubject: benchmark\n\n"
+    return headers + b"x" * max(0, size - len(headers))
+
+
+def append_all(append, data, count, threads):
+    """
+    Runs count appends spread over threads, like concurrent SMTP sessions finishing their messages
+    """
+    def work(share):
+        for __ in range(share):
+            append('bench@localhost', io.BytesIO(data))
+
+    shares = [count // threads + (1 if i < count % threads else 0) for i in range(threads)]
+    workers = [threading.Thread(target=work, args=(share,)) for share in shares]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def run_one_shot(mbox_path, data, args):
+    start = time()
+    append_all(lambda from_text, message_file: daemon.mbox_write_file(mbox_path, from_text, message_file),
+               data, args.messages, args.threads)
+    return time() - start
+
+
+def run_writer(mbox_path, data, args, durability):
+    start = time()
+    with daemon.MboxWriter(mbox_path, durability, args.commit_messages, args.commit_ms) as writer:
+        append_all(writer.append_file, data, args.messages, args.threads)
+    return time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--size', type=int, default=4096, help='message size in bytes')
+    parser.add_argument('--threads', type=int, default=4, help='concurrent appenders')
+    parser.add_argument('--commit-messages', type=int, default=daemon.DEFAULT_COMMIT_MESSAGES)
+    parser.add_argument('--commit-ms', type=int, default=daemon.DEFAULT_COMMIT_MILLISECS)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--dir', default=None, help='directory for the scratch mbox, defaults to the temp dir')
+    args = parser.parse_args()
+
+    data = make_message(args.size)
+    total_bytes = len(data) * args.messages
+    print('%d messages of %d bytes, %d threads, group commit every %d messages / %d ms' % (
+        args.messages, len(data), args.threads, args.commit_messages, args.commit_ms))
+
+    runs = [('open/close', lambda path: run_one_shot(path, data, args))]
+    for durability in daemon.MBOX_DURABILITY_POLICIES:
+        runs.append((durability, lambda path, durability=durability: run_writer(path, data, args, durability)))
+
+    for name, run in runs:
+        timings = []
+        for __ in range(args.rounds):
+            # a directory, so that the index written next to the mbox goes away with it
+            with tempfile.TemporaryDirectory(dir=args.dir) as mbox_dir:
+                timings.append(run(os.path.join(mbox_dir, 'bench.mbox')))
+        best = min(timings)
+        print('%-10s %8.3fs %10.1f msg/s %8.2f MB/s' % (name, best, args.messages / best, total_bytes / best / 1e6))
+
+
+if __name__ == '__main__':
+    main()
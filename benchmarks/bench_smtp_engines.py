@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Replays a captured mailbox against every available SMTP engine and reports the ingest rate.
+
+    python benchmarks/bench_smtp_engines.py captured.mbox --clients 50 --rounds 3
+"""
+
+import argparse
+import mailbox
+import os
+import queue
+import smtplib
+import sys
+import tempfile
+import threading
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import smtp_mailsink as daemon
+
+
+def load_workload(mbox_path, limit=None):
+    messages = []
+    for message in mailbox.mbox(mbox_path):
+        messages.append((message.get_from() or 'sender@localhost', message.as_bytes()))
+        if limit and len(messages) >= limit:
+            break
+    return messages
+
+
+def replay(host, port, messages, clients):
+    chunks = [messages[i::clients] for i in range(clients)]
+
+    def send(chunk):
+        connection = smtplib.SMTP(host, port)
+        for mailfrom, data in chunk:
+            connection.sendmail(mailfrom.split(' ')[0], ['sink@localhost'], data)
+        connection.quit()
+
+    threads = [threading.Thread(target=send, args=(chunk,)) for chunk in chunks if chunk]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_engine(engine, messages, args):
+    mail_queue = queue.Queue()
+
+    # a directory, so that the index written next to the mbox goes away with it
+    with tempfile.TemporaryDirectory() as mbox_dir:
+        mailsink = daemon.SmtpMailsink(host=args.host, port=args.port,
+                                       mailboxFilePath=os.path.join(mbox_dir, 'replay.mbox'),
+                                       mailQueue=mail_queue, engine=engine)
+        mailsink.start()
+        try:
+            start = time()
+            # the sink queues each message before replying 250, so replay() returning means all is ingested
+            replay(args.host, args.port, messages, args.clients)
+            return time() - start
+        finally:
+            mailsink.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('mbox', help='captured mailbox to replay')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=10025)
+    parser.add_argument('--clients', type=int, default=10, help='concurrent SMTP client connections')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--limit', type=int, default=None, help='replay at most this many messages')
+    args = parser.parse_args()
+
+    daemon.DEBUG_SMTP = False
+    messages = load_workload(args.mbox, args.limit)
+    total_bytes = sum(len(data) for __, data in messages)
+
+    print('%d messages, %.1f MB, %d clients' % (len(messages), total_bytes / 1e6, args.clients))
+
+    for engine in sorted(daemon.SMTP_ENGINES):
+        best = min(run_engine(engine, messages, args) for __ in range(args.rounds))
+        print('%-10s %8.3fs %10.1f msg/s %8.2f MB/s' % (engine, best, len(messages) / best,
+                                                          total_bytes / best / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,61 +1,96 @@
 #!/usr/bin/env python3
 # -*- coding: ascii -*-
 
-import _thread
-import asyncore
+import array
 import base64
+import collections
+import concurrent.futures
 import datetime
 import email
+import email.parser
 import glob
 import html
+import json
 import logging
-import mailbox
-import operator
+import multiprocessing
 import os
 import pprint
 import queue
-import re
-import socket
 import subprocess
 import sys
 import threading
 import traceback
+import zlib
 from email.header import decode_header, Header
 from email.utils import parsedate_tz, mktime_tz
 from functools import wraps
 from time import sleep
 from time import time
 
-import smtpd
-
 import lxml as lxml
+import lxml.html
 from PyQt5 import QtCore, QtGui, QtWidgets, QtPrintSupport
 from lxml.html.clean import Cleaner
 import cutesmtp_icons
 from valid_encodings import VALID_ENCODINGS
-import pickle as pickle
+from smtp_mailsink import (SmtpMailsinkServer, SmtpMailsink, SmtpMailsinkPool, PortAlreadyInUseException, MailboxWriteException,
+                           StoredMessage, mbox_write_item, init_logging, SMTP_ENGINES, SMTP_ENGINE_ASYNCIO, SMTP_ENGINE_ASYNCORE,
+                           DEFAULT_SMTP_ENGINE, DEFAULT_PORT, DEFAULT_MBOX_PATH, DEFAULT_HIGH_WATER_MARK, LOG_FILE_NAME,
+                           LOGGER_NAME, format_metrics, load_mbox_index, scan_mbox, MBOX_DURABILITY_POLICIES,
+                           scan_mbox_parallel, flush_mbox_writes, DEFAULT_MBOX_DURABILITY, DEFAULT_COMMIT_MESSAGES,
+                           DEFAULT_COMMIT_MILLISECS, ScanCancelledException, is_last_message_settled)
 
 __all__ = ['cutesmtp_icons',
            'SmtpMailsinkServer',
            'EmailParser']
 
-DEBUG_SMTP = True
-DEBUG_APP = False
-DEFAULT_PORT = 1025
 DISABLE_APPSTATE = False
 APPNAME = 'Cute Pie SMTP Daemon'
 VERSION = '0.17.3.2221 (pyqt5)'
-DEFAULT_MBOX_PATH = 'mailbox.mbox'
-POLLING_TIME_MILLISECS = 1000
-PICKLE_FILE_NAME = "app_cache.appstate"
-PICKLE_IS_LOADED = False
-PICKLE_STATE_DIRTY = False
+PARSED_MESSAGE_CACHE_SIZE = 8  # parsed messages kept around after being displayed
+RENDERED_MESSAGE_CACHE_SIZE = 64  # displayed messages whose HTML and attachments are kept around
+RENDERED_MESSAGE_CACHE_BYTES = 64 * 1024 * 1024  # limit for the HTML and attachments kept around
+RENDER_WORKERS = 2  # threads parsing, decoding and cleaning messages for display
+PREFETCH_NEIGHBORS = 3  # rows above and below the selected one rendered ahead of time
+CLEANING_PROFILE_STYLES = 'styles'
+CLEANING_PROFILE_SCRIPTS = 'scripts'
+CLEANING_PROFILE_FULL = 'full'
+CLEANING_PROFILES = {
+    # removes styling only
+    CLEANING_PROFILE_STYLES: dict(scripts=False, javascript=False, comments=False, style=True, inline_style=True,
+                                  links=False, meta=False, page_structure=False, processing_instructions=False,
+                                  embedded=False, frames=False, forms=False, annoying_tags=False,
+                                  remove_unknown_tags=False, safe_attrs_only=False),
+    # removes what runs or loads code
+    CLEANING_PROFILE_SCRIPTS: dict(scripts=True, javascript=True, comments=False, style=False, links=False,
+                                   meta=False, page_structure=False, processing_instructions=False, embedded=False,
+                                   frames=True, forms=False, annoying_tags=False, remove_unknown_tags=False,
+                                   safe_attrs_only=False),
+    # the sanitization HTML cleaning always did
+    CLEANING_PROFILE_FULL: dict(page_structure=False, links=False, style=True, scripts=True, frames=True),
+}
+DEFAULT_CLEANING_PROFILE = CLEANING_PROFILE_FULL
+RENDER_PLACEHOLDER_HTML = '<div style="color:#888;">Loading message...</div>'
+RENDER_SIZE_BUDGET_KB = 256  # HTML laid out at once, bigger messages are shown in parts
+SHOW_MORE_URL = 'cutepie:show-more'
+SHOW_ALL_URL = 'cutepie:show-all'
+SHOW_MORE_HTML = '''<hr/><div style="color:#888;">%d of %d KB shown.
+<a href="''' + SHOW_MORE_URL + '''">Show more</a> | <a href="''' + SHOW_ALL_URL + '''">Show all</a></div>'''
+FOLLOW_POLL_MILLISECS = 1000  # mailbox growth check when file change notifications are unavailable or missed
+FOLLOW_DEDUP_WINDOW = 20000  # recent message offsets remembered, so that our own appends are not added twice
+MAX_MESSAGES_PER_BATCH = 500  # received messages added to the table per GUI event loop iteration
+LOAD_PROGRESS_MILLISECS = 250  # rows and progress handed to the GUI while a mailbox is loading
+METRICS_REFRESH_MILLISECS = 1000
+APPSTATE_FILE_NAME = "app_cache.appstate"
+APPSTATE_VERSION = 3  # 1 was the pickled table, 2 was rewritten on exit
+APPSTATE_TAIL_BYTES = 4096  # checksummed end of the mbox part the saved table covers
+APPSTATE_IS_LOADED = False
+APPSTATE_COMPACT_MILLISECS = 60000  # how often the appstate log is checked for compaction
+APPSTATE_COMPACT_MIN_CHECKPOINTS = 1000  # the log is compacted once it has more checkpoints than this and than rows
+INDEX_DATE = 1  # epoch timestamp, shown as a QDateTime
 INDEX_HIDDEN_METADATA = 3  # hidden row for message storage
-LOG_FILE_NAME = 'app.log'
-
-LOG = None  # type: logging.Logger
 
-tableview_data = []  # type: list
+LOG = logging.getLogger(LOGGER_NAME)
 
 
 def timed(f):
@@ -98,8 +133,12 @@ class MainWindow(QtWidgets.QMainWindow):
         init_logging(log_file_dir=self.appdata_dir, log_to_file=self.is_log_file_enabled)
         self.init_folders()
 
-        self.textEdit = QtWidgets.QTextEdit()
+        self.textEdit = QtWidgets.QTextBrowser()
         self.textEdit.setReadOnly(True)
+        # only the show more links are followed, see show_message_html()
+        self.textEdit.setOpenLinks(False)
+        self.textEdit.anchorClicked.connect(self.on_message_link_clicked)
+        self.shown_message = None  # (HTML of the displayed message, size limit it is shown with)
 
         self.setCentralWidget(self.textEdit)
 
@@ -115,6 +154,22 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.setUnifiedTitleAndToolBarOnMac(True)
         self.mailsync = None
+        self.metricsTimer = QtCore.QTimer()
+        self.metricsTimer.setInterval(METRICS_REFRESH_MILLISECS)
+        self.metricsTimer.timeout.connect(self.show_smtp_metrics)
+        self.renderer = MessageRenderer()
+        self.renderer.rendered.connect(self.on_message_rendered)
+        self.renderer.failed.connect(self.on_message_render_failed)
+        self.follower = MboxFollower()
+        self.follower.newMessages.connect(self.add_email_items)
+        self.follower.mailboxReplaced.connect(self.reload_mailbox)
+        self.loadJob = None
+        self.loadGeneration = 0
+        self.unloggedRows = []
+        self.appState = None
+        self.appStateTimer = QtCore.QTimer()
+        self.appStateTimer.setInterval(APPSTATE_COMPACT_MILLISECS)
+        self.appStateTimer.timeout.connect(self.compact_appstate)
         self.attachment_buttons = None
         self.attachment_icon = QtGui.QIcon(':/icons/attached.png')
 
@@ -129,11 +184,15 @@ class MainWindow(QtWidgets.QMainWindow):
             self.actionCleanHtmlToggle.setChecked(True)
 
         EmailParser.cleaning_is_enabled = self.isHtmlCleaningEnabled
+        EmailParser.cleaning_profile = self.html_cleaning_profile
 
-        self.pickle_storage_path = os.path.join(self.appdata_dir, PICKLE_FILE_NAME)
+        self.appstate_path = os.path.join(self.appdata_dir, APPSTATE_FILE_NAME)
         self.initialize_data()  # here data init is happening
         self.restore_column_sort_mode()
 
+        if APPSTATE_IS_LOADED:
+            self.on_mailbox_loaded()
+
     def restart_as_root(self):
         euid = os.geteuid()
         if euid != 0:
@@ -185,6 +244,10 @@ class MainWindow(QtWidgets.QMainWindow):
             return
 
         document = self.textEdit.document()
+        if self.shown_message:
+            # all of the message, not just the part laid out before the show more links
+            document = QtGui.QTextDocument()
+            document.setHtml(self.shown_message[0])
         printer = QtPrintSupport.QPrinter()
 
         dlg = QtPrintSupport.QPrintDialog(printer, self)
@@ -209,13 +272,13 @@ class MainWindow(QtWidgets.QMainWindow):
                 return
 
         meta_data = tableview_data[row_index][INDEX_HIDDEN_METADATA]
-        raw_body = meta_data.message
+        raw_body = meta_data.get_raw_message()
 
         raw_message_path = os.path.join(self.appdata_dir, "message.tmp.%s.%s" % (time(), extension))
 
         try:
             with open(raw_message_path, 'wb') as attachmentFile:
-                attachmentFile.write(bytes(raw_body))
+                attachmentFile.write(raw_body)
                 sleep(0.2)
         except IOError as e:
             show_gui_error(e, 'Cannot create file: %s' % raw_message_path)
@@ -267,7 +330,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
         out = QtCore.QTextStream(file_name)
         QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
-        out << self.textEdit.toHtml()
+        out << (self.shown_message[0] if self.shown_message else self.textEdit.toHtml())
         QtWidgets.QApplication.restoreOverrideCursor()
 
         self.statusBar().showMessage("Saved '%s'" % filename, 2000)
@@ -337,6 +400,13 @@ class MainWindow(QtWidgets.QMainWindow):
             triggered=self.on_toggle_toolbar,
             checkable=True)
 
+        self.actionFollowMboxToggle = QtWidgets.QAction(
+            "Follow mailbox file", self,
+            statusTip="Show messages appended to the mailbox by other programs as they arrive",
+            triggered=self.update_follow_mbox_setting,
+            checkable=True)
+        self.actionFollowMboxToggle.setChecked(self.is_follow_mbox_enabled)
+
         self.actionLogToFileEnabled = QtWidgets.QAction(
             "Enable logging to file", self,
             statusTip="Enable logging to file",
@@ -371,12 +441,41 @@ class MainWindow(QtWidgets.QMainWindow):
                                                statusTip="Set SMTP port",
                                                triggered=self.set_port)
 
+        self.actionSetHighWaterMark = QtWidgets.QAction("Ingest queue limit", self,
+                                                        statusTip="Set how many received messages may wait for display "
+                                                                  "before new ones are deferred",
+                                                        triggered=self.set_high_water_mark)
+
+        self.actionSetMboxDurability = QtWidgets.QAction("Mailbox durability", self,
+                                                         statusTip="Set whether received messages are flushed or "
+                                                                   "fsynced to the mailbox file",
+                                                         triggered=self.set_mbox_durability)
+
+        self.actionSetWorkers = QtWidgets.QAction("SMTP worker processes", self,
+                                                  statusTip="Set the number of SMTP listener processes sharing the port",
+                                                  triggered=self.set_smtp_workers)
+
         self.actionCleanHtmlToggle = QtWidgets.QAction("Enable HTML cleaning", self,
                                                        statusTip="Enabling will remove all styling from the markup",
                                                        checkable=True,
                                                        triggered=self.update_html_clean_setting)
         self.actionCleanHtmlToggle.setChecked(self.isHtmlCleaningEnabled)
 
+        self.actionSetRenderSizeBudget = QtWidgets.QAction("Message size shown at once", self,
+                                                           statusTip="Bigger messages are shown in parts",
+                                                           triggered=self.set_render_size_budget)
+
+        self.actionSetHtmlCleaningProfile = QtWidgets.QAction("HTML cleaning profile", self,
+                                                              statusTip="Choose what HTML cleaning removes",
+                                                              triggered=self.set_html_cleaning_profile)
+
+        self.actionLegacySmtpEngineToggle = QtWidgets.QAction("Use legacy asyncore SMTP engine", self,
+                                                              statusTip="Takes effect the next time the SMTP server starts",
+                                                              checkable=True,
+                                                              triggered=self.update_smtp_engine_setting)
+        self.actionLegacySmtpEngineToggle.setChecked(self.smtp_engine == SMTP_ENGINE_ASYNCORE)
+        self.actionLegacySmtpEngineToggle.setEnabled(SMTP_ENGINE_ASYNCORE in SMTP_ENGINES)
+
         # ACTIONS FOR ATTACHMENT CONTEXT MENU
         self.actionAttachmentSave = QtWidgets.QAction("Save &attachment", self,
                                                       statusTip="Save attachment to file",
@@ -405,6 +504,45 @@ class MainWindow(QtWidgets.QMainWindow):
             self.statusBar().showMessage('Set SMTP port to %s' % self.port)
             self.topDock.setWindowTitle(" SMTP status: localhost:%s OFF" % self.port)
 
+    def set_high_water_mark(self):
+        int_value, ok = QtWidgets.QInputDialog.getInt(self,
+                                                      "Ingest queue limit",
+                                                      "Queued messages before SMTP clients are told to retry later\n"
+                                                      "(takes effect on next SMTP start):",
+                                                      self.high_water_mark, 1, 1000000)
+        if ok:
+            self.high_water_mark = int_value
+            self.write_settings()
+            self.statusBar().showMessage('Set ingest queue limit to %s' % self.high_water_mark)
+
+    def set_mbox_durability(self):
+        item, ok = QtWidgets.QInputDialog.getItem(self,
+                                                  "Mailbox durability",
+                                                  "Every %d messages or %d ms, received messages are\n"
+                                                  "none: left buffered, flush: handed to the OS, fsync: on disk\n"
+                                                  "(takes effect on next SMTP start):" % (
+                                                      self.mbox_commit_messages, self.mbox_commit_millisecs),
+                                                  MBOX_DURABILITY_POLICIES,
+                                                  MBOX_DURABILITY_POLICIES.index(self.mbox_durability), False)
+        if ok:
+            self.mbox_durability = item
+            self.write_settings()
+            self.statusBar().showMessage('Set mailbox durability to %s' % self.mbox_durability)
+
+    def show_smtp_metrics(self):
+        if self.mailsync and self.mailsync.is_alive():
+            self.statusBar().showMessage('SMTP %s' % format_metrics(self.mailsync.get_metrics()))
+
+    def set_smtp_workers(self):
+        int_value, ok = QtWidgets.QInputDialog.getInt(self,
+                                                      "SMTP worker processes",
+                                                      "Listener processes (takes effect on next SMTP start):",
+                                                      self.smtp_workers, 1, 64)
+        if ok:
+            self.smtp_workers = int_value
+            self.write_settings()
+            self.statusBar().showMessage('Set SMTP worker processes to %s' % self.smtp_workers)
+
     def on_logging_enabled(self):
         if self.actionLogToFileEnabled.isChecked():
             QtWidgets.QMessageBox.information(self, APPNAME, "Enabled logging to {}".format(
@@ -412,8 +550,6 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def on_open_file(self, filePath=None):
 
-        global PICKLE_STATE_DIRTY
-
         if not filePath:
             filePath, __ = QtWidgets.QFileDialog.getOpenFileName(self,
                                                                  "Select a Mailbox/EML/MSG file...",
@@ -424,24 +560,26 @@ class MainWindow(QtWidgets.QMainWindow):
             self.last_used_fileopen_folder = os.path.dirname(filePath)
 
             if filePath.lower().endswith('.eml') or filePath.lower().endswith('.msg'):
-                with open(filePath, 'r') as fh:
-                    msg = email.message_from_file(fh)
-                    self.add_single_email_item(msg, True)
+                with open(filePath, 'rb') as fh:
+                    msg = email.parser.BytesHeaderParser().parse(fh)
                     fh.seek(0)
                     QtWidgets.QMessageBox.information(self, APPNAME, "Single email message selected."
                                                                      "It will be appended to the current mailbox.")
-                    mbox_write_item(self.mbox_path, msg['From'], fh.read())
-                    PICKLE_STATE_DIRTY = True
+                    try:
+                        stored_message = mbox_write_item(self.mbox_path, str(msg['From']), fh.read())
+                    except MailboxWriteException as e:
+                        show_gui_error(e.__cause__, error_text=str(e))
+                        return
+                self.add_email_items([stored_message])
                 return
 
-            self.textEdit.setHtml("")
+            self.clear_message_html()
+            self.follower.stop()
             self.mbox_path = filePath
             self.write_settings()
             self.statusBar().showMessage('Mailbox: %s' % self.mbox_path)
 
-            del tableview_data[:]
             self.parse_email_items()
-            PICKLE_STATE_DIRTY = True
             self.setWindowTitle("%s - %s" % (APPNAME, self.mbox_path))
 
     def update_html_clean_setting(self):
@@ -449,6 +587,51 @@ class MainWindow(QtWidgets.QMainWindow):
         EmailParser.cleaning_is_enabled = self.isHtmlCleaningEnabled
         self.write_settings()
 
+    def set_html_cleaning_profile(self):
+        profiles = sorted(CLEANING_PROFILES)
+        item, ok = QtWidgets.QInputDialog.getItem(self,
+                                                  "HTML cleaning profile",
+                                                  "When HTML cleaning is enabled, remove\n"
+                                                  "styles: styling only, scripts: scripts and frames,\n"
+                                                  "full: styling, scripts, frames, forms and embedded content:",
+                                                  profiles, profiles.index(self.html_cleaning_profile), False)
+        if ok:
+            self.html_cleaning_profile = item
+            EmailParser.cleaning_profile = self.html_cleaning_profile
+            self.write_settings()
+            self.statusBar().showMessage('Set HTML cleaning profile to %s' % self.html_cleaning_profile)
+
+    def update_smtp_engine_setting(self):
+        if self.actionLegacySmtpEngineToggle.isChecked():
+            self.smtp_engine = SMTP_ENGINE_ASYNCORE
+        else:
+            self.smtp_engine = SMTP_ENGINE_ASYNCIO
+        self.write_settings()
+
+    def update_follow_mbox_setting(self):
+        self.is_follow_mbox_enabled = self.actionFollowMboxToggle.isChecked()
+        self.write_settings()
+
+        if self.is_follow_mbox_enabled:
+            self.on_mailbox_loaded()
+        else:
+            self.follower.stop()
+
+    def on_mailbox_loaded(self):
+        """
+        Follows the mailbox from the end of the last message in the table on
+        """
+        if not self.is_follow_mbox_enabled or self.loadJob:
+            return  # a load in progress starts following once it is done
+
+        self.follower.start(self.mbox_path, tableview_data.end_of_mbox(self.mbox_path))
+
+    def reload_mailbox(self):
+        LOG.info('Mailbox %s was truncated or replaced, reloading', self.mbox_path)
+        self.follower.stop()
+        self.clear_message_html()
+        self.parse_email_items()
+
     def on_toggle_toolbar(self):
         self.is_toolbar_hidden = self.actionToggleToolbar.isChecked()
         self.toolBar.setVisible(not self.is_toolbar_hidden)
@@ -470,29 +653,50 @@ class MainWindow(QtWidgets.QMainWindow):
         if start:
             self.queueSmtpResult = queue.Queue()
 
+            # wired up before the server starts, so that no wakeup gets lost
+            self.queueListener = EmailQueueListener(self.max_messages_per_batch)
+            self.queueListener.set_queue(self.queueSmtpResult)
+            self.queueListener.set_handler(self.add_email_items)
+            self.queueListener.start()
+
             try:
-                self.mailsync = SmtpMailsink(host="0.0.0.0", port=self.port, mailboxFilePath=self.mbox_path,
-                                             mailQueue=self.queueSmtpResult)
+                if self.smtp_workers > 1:
+                    self.mailsync = SmtpMailsinkPool(host="0.0.0.0", port=self.port, mailboxFilePath=self.mbox_path,
+                                                     mailQueue=self.queueSmtpResult, engine=self.smtp_engine,
+                                                     workers=self.smtp_workers, highWaterMark=self.high_water_mark,
+                                                     queueListener=self.queueListener.notify,
+                                                     durability=self.mbox_durability,
+                                                     commitMessages=self.mbox_commit_messages,
+                                                     commitMillisecs=self.mbox_commit_millisecs)
+                else:
+                    self.mailsync = SmtpMailsink(host="0.0.0.0", port=self.port, mailboxFilePath=self.mbox_path,
+                                                 mailQueue=self.queueSmtpResult, engine=self.smtp_engine,
+                                                 highWaterMark=self.high_water_mark,
+                                                 queueListener=self.queueListener.notify,
+                                                 durability=self.mbox_durability,
+                                                 commitMessages=self.mbox_commit_messages,
+                                                 commitMillisecs=self.mbox_commit_millisecs)
+                self.mailsync.start()
             except PortAlreadyInUseException as e:
+                self.queueListener.stop()
                 QtWidgets.QMessageBox.warning(None, APPNAME,
                                               "SMTP port %d is already in use\n\n%s" % (self.port, str(e)))
                 return
+            except (OSError, ValueError, RuntimeError, MailboxWriteException) as e:
+                self.queueListener.stop()
+                show_gui_error(e, 'Failed starting SMTP server')
+                return
 
-            self.mailsync.start()
             self.topDock.setWindowTitle(" smtp@0.0.0.0:%s ON" % self.port)
-
-            #     set polling for new messages every 1 sec
-            self.poller = EmailPoller()
-            self.poller.set_queue(self.queueSmtpResult)
-            self.poller.set_handler(self.add_single_email_item)
-            self.poller.start()
+            self.metricsTimer.start()
 
             self.actionSmtpToggle.setChecked(True)
 
-        elif self.mailsync and self.mailsync.isAlive():
+        elif self.mailsync and self.mailsync.is_alive():
             self.mailsync.stop()
             self.topDock.setWindowTitle(" smtp@0.0.0.0:%s OFF" % self.port)
-            self.poller.stop()
+            self.queueListener.stop()
+            self.metricsTimer.stop()
             # self.actionSmtpToggle.setIconText("&Start SMTP")
 
     def createMenus(self):
@@ -512,15 +716,22 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.viewMenu = self.menuBar().addMenu("&View")
         self.viewMenu.addAction(self.actionToggleToolbar)
+        self.viewMenu.addAction(self.actionFollowMboxToggle)
 
         self.smtpMenu = self.menuBar().addMenu("&SMTP")
         self.smtpMenu.addAction(self.actionSmtpToggle)
 
         self.configMenu = self.menuBar().addMenu("&Config")
         self.configMenu.addAction(self.actionSetPort)
+        self.configMenu.addAction(self.actionSetWorkers)
+        self.configMenu.addAction(self.actionSetHighWaterMark)
+        self.configMenu.addAction(self.actionSetMboxDurability)
         self.configMenu.addAction(self.actionSmtpAutostartToggle)
         self.configMenu.addAction(self.actionCleanHtmlToggle)
+        self.configMenu.addAction(self.actionSetHtmlCleaningProfile)
+        self.configMenu.addAction(self.actionSetRenderSizeBudget)
         self.configMenu.addAction(self.actionLogToFileEnabled)
+        self.configMenu.addAction(self.actionLegacySmtpEngineToggle)
 
         self.helpMenu = self.menuBar().addMenu("&Help")
         self.helpMenu.addAction(self.actionAbout)
@@ -544,6 +755,9 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def createStatusBar(self):
         self.statusBar().showMessage("Ready")
+        # temporary messages, like the SMTP metrics refreshed every second, would hide the layout time
+        self.layoutLabel = QtWidgets.QLabel()
+        self.statusBar().addPermanentWidget(self.layoutLabel)
 
     def createDockWindows(self):
         self.topDock = QtWidgets.QDockWidget(self)
@@ -582,27 +796,36 @@ class MainWindow(QtWidgets.QMainWindow):
 
     @timed
     def initialize_data(self):
-        global tableview_data, PICKLE_IS_LOADED
+        global tableview_data, APPSTATE_IS_LOADED
 
-        if not DISABLE_APPSTATE and os.path.exists(self.pickle_storage_path):
-            LOG.debug('Appstate file found at %s, loading...' % self.pickle_storage_path)
+        position = None
+        if not DISABLE_APPSTATE:
+            self.appState = AppStateLog(self.appstate_path)
+            self.appStateTimer.start()
+
+        if self.appState and os.path.exists(self.appstate_path):
+            LOG.debug('Appstate file found at %s, loading...' % self.appstate_path)
 
             try:
+                listview_table_data_, position = self.appState.replay(self.mbox_path)
                 self.tableView.tableModel.sendSignalLayoutAboutToBeChanged()
-                listview_table_data_ = restore_state(open(self.pickle_storage_path, 'rb'))
-                tableview_data[:] = listview_table_data_[
-                                    :]  # don't assign directly, need to keep the existing reference!
+                # don't assign directly, need to keep the existing reference!
+                tableview_data.clear()
+                tableview_data.extend(listview_table_data_)
                 self.tableView.tableModel.sendSignalLayoutChanged()
-                PICKLE_IS_LOADED = True
+                APPSTATE_IS_LOADED = True
             except Exception as e:
                 LOG.error("Error initializing data", exc_info=e)
 
-        if not PICKLE_IS_LOADED:
+        if not APPSTATE_IS_LOADED:
             LOG.info('Appstate not found or invalid, parsing data...')
-            try:
-                self.parse_email_items()
-            except Exception as e:
-                show_gui_error(e, 'Failed parsing mailbox!')
+        elif position is not None:
+            LOG.info('Mailbox grew since the appstate was saved, indexing from %d...', position)
+        try:
+            if not APPSTATE_IS_LOADED or position is not None:
+                self.parse_email_items(position or 0)
+        except Exception as e:
+            show_gui_error(e, 'Failed parsing mailbox!')
 
                 # self.tableView.resizeColumnsToContents()
 
@@ -650,30 +873,40 @@ class MainWindow(QtWidgets.QMainWindow):
         #  TODO: clear layout
         # self.clearLayout(self.bottomDock)
         meta_data = tableview_data[rowIndex][INDEX_HIDDEN_METADATA]
-        email_message = meta_data.message
-        headers = meta_data.headers
-        email_body, attachments = EmailParser.parse_email_body(email_message)
-
-        if not email_body:
-            email_body = '<pre>[invalid message body]</pre><hr/>\n' + email_message.as_string()
-
-        html_headers = []
+        rendered_message = RENDERED_MESSAGES.get(meta_data.stored_message, render=False)
 
-        for header in list(headers.keys()):
-
-            header_value = headers[header]
+        if rendered_message:
+            self.renderer.cancel()
+            self.show_rendered_message(*rendered_message)
+        else:
+            # a big message takes a while, the GUI is kept responsive meanwhile
+            self.clear_message_html(RENDER_PLACEHOLDER_HTML)
+            self.renderer.request(meta_data.stored_message)
 
-            if isinstance(header_value, str):
+        self.prefetch_neighbors(rowIndex)
 
-                if header in ("From", "To"):
-                    header_value = html.escape(header_value)
+    def prefetch_neighbors(self, rowIndex):
+        """
+        Renders the rows around the selected one, nearest first and the next before the previous,
+        so that browsing with the arrow keys finds them in the cache
+        """
+        neighbors = []
+        for distance in range(1, PREFETCH_NEIGHBORS + 1):
+            for neighbor in (rowIndex + distance, rowIndex - distance):
+                if 0 <= neighbor < len(tableview_data):
+                    neighbors.append(tableview_data[neighbor][INDEX_HIDDEN_METADATA].stored_message)
+        self.renderer.prefetch(neighbors)
 
-                html_headers.append('<b>%s</b>: %s' % (header, header_value))
+    def on_message_rendered(self, request_id, message_html, attachments):
+        if self.renderer.is_current(request_id):
+            self.show_rendered_message(message_html, attachments)
 
-        htmlheaders_div = '''<div style="font-size:10pt; color:#888;">
-{0}</div><hr/>'''.format("<br/>\n".join(html_headers))
+    def on_message_render_failed(self, request_id, error):
+        if self.renderer.is_current(request_id):
+            self.clear_message_html('<pre>[cannot display message: %s]</pre>' % html.escape(str(error)))
 
-        self.textEdit.setHtml(htmlheaders_div + email_body)
+    def show_rendered_message(self, message_html, attachments):
+        self.show_message_html(message_html, self.render_size_budget * 1024)
 
         if attachments and len(attachments):
 
@@ -710,6 +943,52 @@ class MainWindow(QtWidgets.QMainWindow):
             self.bottomDock.show()
             self.bottomDock.setMinimumHeight(32)
 
+    def show_message_html(self, message_html, limit):
+        """
+        Lays out at most limit characters of the message, with links to show more, since the time
+        QTextEdit takes grows faster than the size of the document
+        :param limit: None for all of it
+        """
+        shown_html = message_html
+        cut = len(message_html)
+        if limit and len(message_html) > limit:
+            cut = html_truncation_point(message_html, limit)
+            shown_html = message_html[:cut] + SHOW_MORE_HTML % (cut // 1024, len(message_html) // 1024)
+        self.shown_message = (message_html, limit)
+
+        start = time()
+        self.textEdit.setHtml(shown_html)
+        elapsed = time() - start
+
+        self.layoutLabel.setText('Message laid out in %.0f ms, %d of %d KB shown' % (
+            elapsed * 1000, cut // 1024, len(message_html) // 1024))
+
+    def clear_message_html(self, placeholder_html=''):
+        # a render still running for the previous selection or mailbox must not draw into the cleared view
+        self.renderer.cancel()
+        self.shown_message = None
+        self.layoutLabel.clear()
+        self.textEdit.setHtml(placeholder_html)
+
+    def on_message_link_clicked(self, url):
+        if not self.shown_message:
+            return
+        message_html, limit = self.shown_message
+        if url.toString() == SHOW_MORE_URL:
+            self.show_message_html(message_html, limit * 2)
+        elif url.toString() == SHOW_ALL_URL:
+            self.show_message_html(message_html, None)
+
+    def set_render_size_budget(self):
+        int_value, ok = QtWidgets.QInputDialog.getInt(self,
+                                                      "Message size shown at once",
+                                                      "KB of message HTML laid out before 'Show more':",
+                                                      self.render_size_budget, 16, 1024 * 1024)
+        if ok:
+            self.render_size_budget = int_value
+            self.write_settings()
+            self.statusBar().showMessage('Set message size shown at once to %s KB' % self.render_size_budget)
+
     def on_attachment_context_menu_selection(self):
         """
         Triggered when an item is selected in the rich-click context menu on an attachment button
@@ -795,14 +1074,40 @@ class MainWindow(QtWidgets.QMainWindow):
             "smtp_autostart", type=bool) or False
         self.isHtmlCleaningEnabled = self.settings.contains('clean_html') and self.settings.value(
             "clean_html", type=bool) or False
+        self.html_cleaning_profile = self.settings.contains('html_cleaning_profile') and self.settings.value(
+            "html_cleaning_profile") or DEFAULT_CLEANING_PROFILE
+        if self.html_cleaning_profile not in CLEANING_PROFILES:
+            self.html_cleaning_profile = DEFAULT_CLEANING_PROFILE
         self.last_saved_sort_column = self.settings.contains('last_saved_sort_column') and self.settings.value(
             "last_saved_sort_column", type=int) or None
         self.last_saved_sort_order = self.settings.contains('last_saved_sort_order') and self.settings.value(
             "last_saved_sort_order", type=int) or None
         self.is_toolbar_hidden = self.settings.contains('is_toolbar_hidden') and self.settings.value(
             "is_toolbar_hidden", type=bool) or False
+        self.is_follow_mbox_enabled = self.settings.contains('follow_mbox') and self.settings.value(
+            "follow_mbox", type=bool) or False
         self.is_log_file_enabled = self.settings.contains('is_log_file_enabled') and self.settings.value(
             "is_log_file_enabled", type=bool) or False
+        self.smtp_engine = self.settings.contains('smtp_engine') and self.settings.value(
+            "smtp_engine") or DEFAULT_SMTP_ENGINE
+        if self.smtp_engine not in SMTP_ENGINES:
+            self.smtp_engine = DEFAULT_SMTP_ENGINE
+        self.smtp_workers = self.settings.contains('smtp_workers') and self.settings.value(
+            "smtp_workers", type=int) or 1
+        self.render_size_budget = self.settings.contains('render_size_budget') and self.settings.value(
+            "render_size_budget", type=int) or RENDER_SIZE_BUDGET_KB
+        self.high_water_mark = self.settings.contains('high_water_mark') and self.settings.value(
+            "high_water_mark", type=int) or DEFAULT_HIGH_WATER_MARK
+        self.max_messages_per_batch = self.settings.contains('max_messages_per_batch') and self.settings.value(
+            "max_messages_per_batch", type=int) or MAX_MESSAGES_PER_BATCH
+        self.mbox_durability = self.settings.contains('mbox_durability') and self.settings.value(
+            "mbox_durability") or DEFAULT_MBOX_DURABILITY
+        if self.mbox_durability not in MBOX_DURABILITY_POLICIES:
+            self.mbox_durability = DEFAULT_MBOX_DURABILITY
+        self.mbox_commit_messages = self.settings.contains('mbox_commit_messages') and self.settings.value(
+            "mbox_commit_messages", type=int) or DEFAULT_COMMIT_MESSAGES
+        self.mbox_commit_millisecs = self.settings.contains('mbox_commit_millisecs') and self.settings.value(
+            "mbox_commit_millisecs", type=int) or DEFAULT_COMMIT_MILLISECS
 
     def write_settings(self):
         settings = QtCore.QSettings(QtCore.QSettings.IniFormat, QtCore.QSettings.UserScope, "xh", APPNAME)
@@ -812,16 +1117,28 @@ class MainWindow(QtWidgets.QMainWindow):
         settings.setValue("mbox_path", str(self.mbox_path))
         settings.setValue("smtp_autostart", self.isSmtpAutostartEnabled)
         settings.setValue("clean_html", self.isHtmlCleaningEnabled)
+        settings.setValue("html_cleaning_profile", self.html_cleaning_profile)
         settings.setValue("last_saved_sort_column", self.last_saved_sort_column)
         settings.setValue("last_saved_sort_order", self.last_saved_sort_order)
         settings.setValue("is_toolbar_hidden", self.is_toolbar_hidden)
+        settings.setValue("follow_mbox", self.is_follow_mbox_enabled)
         settings.setValue("is_log_file_enabled", self.actionLogToFileEnabled.isChecked())
+        settings.setValue("smtp_engine", self.smtp_engine)
+        settings.setValue("smtp_workers", self.smtp_workers)
+        settings.setValue("render_size_budget", self.render_size_budget)
+        settings.setValue("high_water_mark", self.high_water_mark)
+        settings.setValue("max_messages_per_batch", self.max_messages_per_batch)
+        settings.setValue("mbox_durability", self.mbox_durability)
+        settings.setValue("mbox_commit_messages", self.mbox_commit_messages)
+        settings.setValue("mbox_commit_millisecs", self.mbox_commit_millisecs)
 
         settings.sync()
 
     def closeEvent(self, event):
 
-        if self.mailsync and self.mailsync.isAlive():
+        self.renderer.shutdown()
+
+        if self.mailsync and self.mailsync.is_alive():
             self.mailsync.stop()
 
         if self.tableView.tableModel.last_saved_sort_column and self.tableView.tableModel.last_saved_sort_order:
@@ -833,8 +1150,10 @@ class MainWindow(QtWidgets.QMainWindow):
         LOG.info('Cleanup...')
         delete_temp_files(self.appdata_dir, '*.tmp.*')
 
-        if not DISABLE_APPSTATE:
-            self.save_appstate()
+        self.cancel_loading()
+        if self.appState:
+            self.appStateTimer.stop()
+            self.appState.close()
 
         return
         quit_msg = "Are you sure you want to exit the program?"
@@ -848,97 +1167,246 @@ class MainWindow(QtWidgets.QMainWindow):
         else:
             event.ignore()
 
-    @timed
-    def save_appstate(self):
+    def compact_appstate(self):
+        if not self.loadJob and self.appState.needs_compaction():
+            self.appState.compact()
 
-        if PICKLE_IS_LOADED and not PICKLE_STATE_DIRTY:
-            # avoid resaving appstate if it did not change
-            LOG.info('App state data unchanged. Skipping saving appstate!')
-            return
+    def add_email_items(self, stored_messages):
+        """
+        Adds a batch of received messages as one contiguous row insert
+        :type stored_messages: list of StoredMessage
+        """
+        # when following the mailbox, our own appends show up there as well
+        stored_messages = self.follower.claim(stored_messages)
+        rows = []
 
-        LOG.info('Serializing appstate to file %s', self.pickle_storage_path)
-        fhandle = open(self.pickle_storage_path, 'wb')
-        save_state(tableview_data, fhandle)
+        for stored_message in stored_messages:
+            try:
+                rows.append(self.build_stored_table_row(stored_message))
+            except Exception as e:
+                LOG.error('Error parsing message at %d. Skipping..', stored_message.offset, exc_info=e)
 
-    def add_single_email_item(self, email_message, isSendUpdateModelSignal=True):
+        self.append_rows(rows)
+
+    def append_rows(self, rows):
         """
-        This method is called both from bulk parsing, and single message parsing which required
-        the update signals to be sent
+        Adds rows to the table and to the appstate log. Rows added while a load is running are logged
+        once it is done, along with the loaded ones
         """
+        if not self.tableView.tableModel.appendRows(rows) or not self.appState:
+            return
+        if self.loadJob:
+            self.unloggedRows.extend(rows)
+        else:
+            self.appState.append(rows)
 
-        headers = EmailParser.parse_email_headers(email_message)
+    @staticmethod
+    def build_stored_table_row(stored_message):
+        """
+        Row from the raw headers known by the index. Only the columns and the message's location are kept,
+        the message itself is parsed when displayed
+        :type stored_message: StoredMessage
+        """
+        headers = EmailParser.parse_email_headers(stored_message.get_headers())
+
+        # the date column is kept as a timestamp, sortable and turned into a QDateTime when displayed
+        timestamp = int(headers.get('timestamp', 0))
 
-        if isSendUpdateModelSignal:
-            self.tableView.tableModel.sendSignalLayoutAboutToBeChanged()
+        return (headers.get('From', '[empty]'),
+                timestamp,
+                headers.get('Subject', '[empty]'),
+                ItemMetaData(StoredMessage(stored_message.mbox_path, stored_message.offset, stored_message.length))
+                )
 
-        # special treatment for the date column, since it needs to be sortable
-        # therefore using a QTableWidgetItem for it
-        timestamp = headers.get('timestamp', 0)
+    def parse_email_items(self, position=0):
+        """
+        (Re)loads the table from the mailbox in a background job, cancelling the one still running
+        :param position: only add the messages from this offset on to the table, which is kept
+        """
+        self.follower.stop()
+        self.cancel_loading()
+        if not position:
+            PARSED_MESSAGES.clear()
+            RENDERED_MESSAGES.clear()
+            self.clear_table()
+            del self.unloggedRows[:]
+
+        self.loadGeneration += 1
+        self.loadJob = MailboxLoadJob(self.mbox_path, self.loadGeneration, position)
+        self.loadJob.rowsLoaded.connect(self.on_rows_loaded)
+        self.loadJob.progress.connect(self.on_load_progress)
+        self.loadJob.finished.connect(self.on_load_finished)
+        self.loadJob.failed.connect(self.on_load_failed)
+        self.loadJob.start()
+
+    def cancel_loading(self):
+        if self.loadJob:
+            self.loadJob.cancel()
+            self.loadJob = None
+            # batches and the finished() signal the job already queued must not reach the table
+            self.loadGeneration += 1
+
+    def on_rows_loaded(self, generation, rows):
+        if generation != self.loadGeneration:
+            LOG.debug('Discarding %d rows of a superseded load', len(rows))
+            return
+        self.append_rows(rows)
 
-        if isinstance(timestamp, float):
-            timestamp = int(timestamp)
-        qDate = QtCore.QDateTime.fromTime_t(timestamp)
+    def on_load_progress(self, generation, count, total, messages_per_sec, bytes_per_sec, eta):
+        if generation != self.loadGeneration:
+            return
+        self.topDock.setWindowTitle("Loading messages: %s of %s, %.0f msg/s, %.1f MB/s, %ds left..." % (
+            count, total, messages_per_sec, bytes_per_sec / 1e6, eta))
 
-        tableview_data.append((headers.get('From', '[empty]'),
-                               qDate,
-                               headers.get('Subject', '[empty]'),
-                               ItemMetaData(email_message, headers)
-                               )
-                              )
+    def on_load_finished(self, generation, count):
+        if generation != self.loadGeneration:
+            return
 
-        if isSendUpdateModelSignal:
-            self.tableView.tableModel.sendSignalLayoutChanged()
+        position = self.loadJob.position
+        self.loadJob = None
+        if self.appState and position:
+            self.appState.append(self.unloggedRows)
+        elif self.appState:
+            # a fresh table, which the log is rewritten with in the background
+            self.appState.compact(tableview_data.entries(self.mbox_path), self.mbox_path)
+        del self.unloggedRows[:]
+        LOG.info('Total messages parsed: %d', count)
+        self.topDock.setWindowTitle("Total messages: %s" % len(tableview_data))
+        self.on_mailbox_loaded()
+
+    def on_load_failed(self, generation, error):
+        if generation != self.loadGeneration:
+            return
+        self.loadJob = None
+        # the follower was stopped for the load, it goes on after the rows that made it into the table
+        self.on_mailbox_loaded()
+        show_gui_error(error, 'Failed parsing mailbox!')
 
-    def parse_email_items(self):
+    def clear_table(self):
+        self.tableView.tableModel.sendSignalLayoutAboutToBeChanged()
+        tableview_data.clear()
+        self.tableView.tableModel.sendSignalLayoutChanged()
+
+
+class MailboxLoadJob(QtCore.QObject):
+    """
+    Builds the table rows of a mailbox on a worker thread. Nothing is touched outside the job: the rows
+    are handed over in batches with rowsLoaded(), which is delivered on the GUI thread, and every signal
+    carries the generation the job was started for, so that results of a load which was superseded in
+    the meantime can be dropped. Batches and progress are published at most every progress_millisecs.
+    cancel() makes the worker stop at the next message.
+    """
+    rowsLoaded = QtCore.pyqtSignal(int, object)  # generation, list of table rows
+    # generation, messages loaded, messages in the mailbox, messages/s, bytes/s, seconds left
+    progress = QtCore.pyqtSignal(int, int, int, float, float, float)
+    finished = QtCore.pyqtSignal(int, int)  # generation, messages loaded
+    failed = QtCore.pyqtSignal(int, object)  # generation, exception
+    cancelled = QtCore.pyqtSignal(int)  # generation
+
+    def __init__(self, mbox_path, generation, position=0, progress_millisecs=LOAD_PROGRESS_MILLISECS):
         """
-        start parser thread in a separate thread
+        :param position: scan the mbox for the messages from this offset on instead of loading all of them
         """
-        _thread.start_new_thread(self.parse_email_items_task, ())
+        super(MailboxLoadJob, self).__init__()
+        self.mbox_path = mbox_path
+        self.generation = generation
+        self.position = position
+        self.progress_interval = progress_millisecs / 1000.0
+        self.cancel_event = threading.Event()
+        self.thread = None
 
-    @timed
-    def parse_email_items_task(self):
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='mailbox-load-%d' % self.generation)
+        self.thread.daemon = True
+        self.thread.start()
 
-        mbox = mailbox.mbox(self.mbox_path)
-        num_total = 0
+    def cancel(self):
+        self.cancel_event.set()
 
-        # table model update start
-        self.tableView.tableModel.sendSignalLayoutAboutToBeChanged()
+    def is_cancelled(self):
+        return self.cancel_event.is_set()
 
-        for count, email_message in enumerate(mbox):
+    @timed
+    def run(self):
+        rows = []
+        count = 0
+        loaded_bytes = 0
+        try:
+            # only the index is read, message bodies are fetched from the mbox when displayed
+            if self.position:
+                stored_messages = [StoredMessage(self.mbox_path, offset, length, headers)
+                                   for __, offset, length, headers in scan_mbox_parallel(self.mbox_path, self.position,
+                                                                                         cancel=self.cancel_event)]
+            else:
+                stored_messages = load_mbox_index(self.mbox_path, self.cancel_event)
+            started = last_published = time()
+
+            for count, stored_message in enumerate(stored_messages, 1):
+                if self.is_cancelled():
+                    LOG.info('Loading %s cancelled after %d messages', self.mbox_path, count - 1)
+                    self.cancelled.emit(self.generation)
+                    return
+
+                try:
+                    rows.append(MainWindow.build_stored_table_row(stored_message))
+                except Exception as e:
+                    LOG.error('Error parsing message at %d. Skipping..', stored_message.offset, exc_info=e)
+                loaded_bytes += stored_message.length
+
+                now = time()
+                if now - last_published >= self.progress_interval:
+                    last_published = now
+                    self.rowsLoaded.emit(self.generation, rows)
+                    rows = []
+                    self.publish_progress(count, len(stored_messages), loaded_bytes, now - started)
+        except ScanCancelledException:
+            LOG.info('Loading %s cancelled while scanning', self.mbox_path)
+            self.cancelled.emit(self.generation)
+            return
+        except Exception as e:
+            LOG.error('Error loading mailbox %s', self.mbox_path, exc_info=e)
+            self.failed.emit(self.generation, e)
+            return
 
-            try:
-                self.add_single_email_item(email_message)
-            except Exception as e:
-                LOG.error('Error parsing message %s. Skipping..', pprint.pformat(email_message), exc_info=e)
+        if self.is_cancelled():
+            self.cancelled.emit(self.generation)
+            return
 
-            if count % 100 == 0:
-                LOG.info('%d', count)
-            self.topDock.setWindowTitle("Loading messages: %s..." % count)
-            num_total = count
+        if rows:
+            self.rowsLoaded.emit(self.generation, rows)
+        self.finished.emit(self.generation, count)
 
-        #####  magic model update end
-        self.tableView.tableModel.sendSignalLayoutChanged()
-        LOG.info('Total messages parsed: %d', num_total)
-        self.topDock.setWindowTitle("Total messages: %s" % num_total)
+    def publish_progress(self, count, total, loaded_bytes, elapsed):
+        messages_per_sec = count / elapsed if elapsed else 0.0
+        bytes_per_sec = loaded_bytes / elapsed if elapsed else 0.0
+        eta = (total - count) / messages_per_sec if messages_per_sec else 0.0
+        self.progress.emit(self.generation, count, total, messages_per_sec, bytes_per_sec, eta)
 
 
-class EmailPoller:
+class EmailQueueListener(QtCore.QObject):
     """
+    Drains the SMTP result queue on the GUI thread. The SMTP side calls notify() from its own thread,
+    which wakes the GUI up through a queued signal instead of polling; wakeups are coalesced, and at most
+    batch_size messages are handed to the handler per event loop iteration, so the UI stays responsive.
+
     :type queue: Queue.Queue
     """
+    newItemsQueued = QtCore.pyqtSignal()
 
-    def __init__(self):
-        self.timer = QtCore.QTimer()
-        self.timer.setInterval(POLLING_TIME_MILLISECS)
-        self.timer.timeout.connect(self.check_for_new_items)
+    def __init__(self, batch_size=MAX_MESSAGES_PER_BATCH):
+        super(EmailQueueListener, self).__init__()
+        self.batch_size = batch_size
         self.queue = None
         self.handler = None
+        self.is_listening = False
+        self.wakeup_pending = False
+        self.newItemsQueued.connect(self.check_for_new_items, QtCore.Qt.QueuedConnection)
 
     def start(self):
-        self.timer.start()
+        self.is_listening = True
 
     def stop(self):
-        self.timer.stop()
+        self.is_listening = False
 
     def set_queue(self, queue=None):
         self.queue = queue
@@ -946,10 +1414,16 @@ class EmailPoller:
     def set_handler(self, handler):
         self.handler = handler
 
-    # @QtCore.pyqtSlot()
-    def check_for_new_items(self):
+    def notify(self):
+        """
+        Thread-safe, called by the SMTP side after queuing a message
+        """
+        if self.is_listening and not self.wakeup_pending:
+            self.wakeup_pending = True
+            self.newItemsQueued.emit()
 
-        global PICKLE_STATE_DIRTY
+    @QtCore.pyqtSlot()
+    def check_for_new_items(self):
 
         if not self.queue:
             raise Exception("You forgot to set a Queue object")
@@ -957,18 +1431,192 @@ class EmailPoller:
         if not self.handler:
             raise Exception("You forgot to set a handler")
 
+        # cleared before draining: a message queued from now on triggers another wakeup
+        self.wakeup_pending = False
+        stored_messages = []
+
+        while len(stored_messages) < self.batch_size:
+            try:
+                stored_messages.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        if stored_messages:
+            self.handler(stored_messages)
+
         if not self.queue.empty():
-            raw_email = self.queue.get()
+            # let the event loop paint before the next batch
+            QtCore.QTimer.singleShot(0, self.check_for_new_items)
 
-            if raw_email:
-                raw_email = re.sub("""<style.*?</style>""", '', raw_email)
-                emailMessage = email.message_from_string(raw_email)
-                self.handler(emailMessage, isSendUpdateModelSignal=True)
-                PICKLE_STATE_DIRTY = True
+
+class MboxFollower(QtCore.QObject):
+    """
+    Follow mode: parses only what other programs append to the mailbox. Growth is noticed through
+    QFileSystemWatcher (inotify on Linux), with stat polling as a fallback. A mailbox that shrank or was
+    replaced by another file is reported with mailboxReplaced, so that it gets reindexed.
+    """
+    newMessages = QtCore.pyqtSignal(object)  # list of StoredMessage
+    mailboxReplaced = QtCore.pyqtSignal()
+
+    def __init__(self, poll_millisecs=FOLLOW_POLL_MILLISECS):
+        super(MboxFollower, self).__init__()
+        self.mbox_path = None
+        self.offset = 0
+        self.identity = None
+        self.last_size = None
+        self.is_tail_pending = False
+        self.claimed = set()
+        self.claimed_order = collections.deque()
+        self.watcher = QtCore.QFileSystemWatcher()
+        self.watcher.fileChanged.connect(self.check_for_new_messages)
+        self.timer = QtCore.QTimer()
+        self.timer.setInterval(poll_millisecs)
+        self.timer.timeout.connect(self.check_for_new_messages)
+
+    def is_following(self):
+        return self.mbox_path is not None
+
+    def start(self, mbox_path, offset):
+        """
+        :param offset: where the last message already in the table ends
+        """
+        self.stop()
+        try:
+            stat = os.stat(mbox_path)
+        except OSError as e:
+            LOG.error('Cannot follow mailbox %s: %s', mbox_path, e)
+            return
+
+        self.mbox_path = mbox_path
+        self.offset = offset
+        self.identity = (stat.st_dev, stat.st_ino)
+        self.last_size = None
+        self.is_tail_pending = False
+        self.watcher.addPath(mbox_path)
+        self.timer.start()
+        self.check_for_new_messages()
+
+    def stop(self):
+        self.timer.stop()
+        if self.watcher.files():
+            self.watcher.removePaths(self.watcher.files())
+        self.mbox_path = None
+        self.claimed.clear()
+        self.claimed_order.clear()
+
+    def claim(self, stored_messages):
+        """
+        :return: the messages not added to the table yet, marking them as added
+        """
+        if not self.is_following():
+            return stored_messages
+
+        unclaimed = []
+        for stored_message in stored_messages:
+            if stored_message.offset in self.claimed:
+                continue
+            unclaimed.append(stored_message)
+            self.claimed.add(stored_message.offset)
+            self.claimed_order.append(stored_message.offset)
+            if len(self.claimed_order) > FOLLOW_DEDUP_WINDOW:
+                self.claimed.discard(self.claimed_order.popleft())
+
+        return unclaimed
+
+    def check_for_new_messages(self):
+        if not self.is_following():
+            return
+
+        try:
+            # our own MboxWriter may have handed only part of a buffered message to the OS,
+            # which would look like a settled but truncated last message
+            flush_mbox_writes(self.mbox_path)
+            stat = os.stat(self.mbox_path)
+        except OSError:
+            return  # being replaced, the next check sees the new file
+
+        if self.mbox_path not in self.watcher.files():
+            # the watch is lost when the file is replaced
+            self.watcher.addPath(self.mbox_path)
+
+        if (stat.st_dev, stat.st_ino) != self.identity or stat.st_size < self.offset:
+            self.stop()
+            self.mailboxReplaced.emit()
+            return
+
+        if stat.st_size == self.last_size and not self.is_tail_pending:
+            return
+
+        is_settled = stat.st_size == self.last_size
+        self.last_size = stat.st_size
+
+        try:
+            # read only: the index is left to whoever writes the mailbox
+            scanned = list(scan_mbox(self.mbox_path, self.offset, stat.st_size))
+            # the last message may still be being written, it is taken once the size stopped changing
+            # and, if another process writes the mailbox, once its writer indexed it
+            self.is_tail_pending = bool(scanned) and not (
+                is_settled and is_last_message_settled(self.mbox_path, scanned[-1], stat.st_size))
+        except OSError as e:
+            LOG.error('Cannot read mailbox %s: %s', self.mbox_path, e)
+            return
+
+        if self.is_tail_pending:
+            scanned.pop()
+        if not scanned:
+            return
+
+        __, offset, length, __ = scanned[-1]
+        self.offset = offset + length
+        self.newMessages.emit([StoredMessage(self.mbox_path, offset, length, headers)
+                               for __, offset, length, headers in scanned])
 
 
 class EmailParser:
     cleaning_is_enabled = False
+    cleaning_profile = DEFAULT_CLEANING_PROFILE
+
+    @staticmethod
+    def parse_stored_message(stored_message):
+        """
+        Feeds the message from the mbox to the parser chunk by chunk, without an intermediate copy of the raw bytes
+        :type stored_message: StoredMessage
+        """
+        parser = email.parser.BytesFeedParser()
+
+        for chunk in stored_message.read_chunks():
+            parser.feed(chunk)
+
+        return parser.close()
+
+    @staticmethod
+    def render_email(email_message):
+        """
+        :return: (headers and body as HTML, attachments)
+        """
+        headers = EmailParser.parse_email_headers(email_message)
+        email_body, attachments = EmailParser.parse_email_body(email_message)
+
+        if not email_body:
+            email_body = '<pre>[invalid message body]</pre><hr/>\n' + email_message.as_string()
+
+        html_headers = []
+
+        for header in list(headers.keys()):
+
+            header_value = headers[header]
+
+            if isinstance(header_value, str):
+
+                if header in ("From", "To"):
+                    header_value = html.escape(header_value)
+
+                html_headers.append('<b>%s</b>: %s' % (header, header_value))
+
+        htmlheaders_div = '''<div style="font-size:10pt; color:#888;">
+{0}</div><hr/>'''.format("<br/>\n".join(html_headers))
+
+        return htmlheaders_div + email_body, attachments
 
     @staticmethod
     def parse_email_body(email_message):
@@ -1136,6 +1784,13 @@ class EmailParser:
         try:
             payload = part.get_payload(decode=True)
 
+            if (isinstance(payload, bytes) and content_type == 'text/html' and EmailParser.cleaning_is_enabled
+                    and HTML_CLEANER.has_markup(payload)):
+                cleaned = HTML_CLEANER.clean(payload, charset if charset in VALID_ENCODINGS else None,
+                                             EmailParser.cleaning_profile)
+                if cleaned is not None:
+                    return cleaned
+
             if isinstance(payload, bytes) and len(payload):
                 if charset and charset in VALID_ENCODINGS:
                     try:
@@ -1156,25 +1811,64 @@ class EmailParser:
         if not payload:
             return ""
 
-        if content_type and content_type == 'text/html' and EmailParser.cleaning_is_enabled and len(payload.strip()):
+        return payload
 
-            try:
-                if Cleaner and payload:
 
-                    cleaner = Cleaner(page_structure=False, links=False, style=True, scripts=True, frames=True)
-                    if isinstance(payload, str):
-                        payload = payload.encode("utf-8")
-                    payload = cleaner.clean_html(payload)
-            except (lxml.etree.ParserError, UnicodeDecodeError, ValueError) as e:
-                LOG.error("Html cleaning error:", exc_info=e)
+class HtmlCleaner:
+    """
+    HTML cleaning with one Cleaner per profile, configured once, see CLEANING_PROFILES. The raw part is parsed
+    straight from its bytes, in its charset, cleaned in place and serialized once, so that it is neither decoded
+    nor copied beforehand.
+    """
 
-        if isinstance(payload, bytes):
+    def __init__(self, profiles=CLEANING_PROFILES):
+        self.cleaners = dict((name, Cleaner(**options)) for name, options in profiles.items())
+        self.parsers = threading.local()  # lxml parsers must not be shared between threads
+
+    @staticmethod
+    def has_markup(payload):
+        """
+        Without a single tag there is nothing to clean
+        """
+        return b'<' in payload
+
+    @staticmethod
+    def declares_charset(payload):
+        """
+        A <meta> charset must come within the first 1024 bytes, libxml2 then picks the encoding up by itself
+        """
+        return b'charset' in payload[:1024].lower()
+
+    def clean(self, payload, charset, profile):
+        """
+        :type payload: bytes
+        :param charset: None if unknown, then the document's own <meta> charset is used, or else UTF-8
+        :return: the cleaned HTML, None if it cannot be parsed
+        """
+        if charset is None and not self.declares_charset(payload):
+            charset = 'utf-8'
+        try:
             try:
-                payload = str(payload, 'utf-8', errors='ignore')
-            except Exception as e:
-                LOG.error('Error decoding email part', e)
+                document = lxml.html.fromstring(payload, parser=self.get_parser(charset))
+            except LookupError:
+                # a charset libxml2 does not know, decoded by Python instead
+                document = lxml.html.fromstring(payload.decode(charset, errors='ignore'))
+            self.cleaners[profile](document)
+            return lxml.html.tostring(document, encoding='unicode')
+        except (lxml.etree.ParserError, LookupError, UnicodeDecodeError, ValueError) as e:
+            LOG.error("Html cleaning error:", exc_info=e)
+            return None
 
-        return payload
+    def get_parser(self, charset):
+        parsers = self.parsers.__dict__
+        parser = parsers.get(charset)
+        if parser is None:
+            # without an encoding libxml2 detects it from the document
+            parser = parsers[charset] = lxml.html.HTMLParser(encoding=charset) if charset else lxml.html.HTMLParser()
+        return parser
+
+
+HTML_CLEANER = HtmlCleaner()
 
 
 class EmailTableView(QtWidgets.QTableView):
@@ -1209,6 +1903,156 @@ class EmailTableView(QtWidgets.QTableView):
 
 
 # http://www.saltycrane.com/blog/2007/06/pyqt-42-qabstracttablemodelqtableview/
+class MessageTable:
+    """
+    The table's rows, stored by column: senders and mailbox paths interned, timestamps and the messages'
+    locations in arrays, subjects UTF-8 encoded one after another in a single buffer. A row costs a few dozen
+    bytes plus its subject, instead of a tuple of objects. Rows are still handed in and out as
+    (From, timestamp, Subject, ItemMetaData) tuples, which are built on access.
+
+    The columns keep the rows in the order they were added, sorting only rearranges the order array,
+    which maps the table's rows to them.
+    """
+
+    def __init__(self):
+        self.senders = []
+        self.sender_ids = {}
+        self.mbox_paths = []
+        self.mbox_path_ids = {}
+        self.subject_buffer = bytearray()
+        self.clear()
+
+    def clear(self):
+        del self.senders[:]
+        self.sender_ids.clear()
+        del self.mbox_paths[:]
+        self.mbox_path_ids.clear()
+        del self.subject_buffer[:]
+        self.sender_column = array.array('i')
+        self.timestamp_column = array.array('q')
+        self.subject_starts = array.array('q')
+        self.subject_lengths = array.array('i')
+        self.mbox_path_column = array.array('i')
+        self.offset_column = array.array('q')
+        self.length_column = array.array('q')
+        self.order = array.array('i')
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, row):
+        row = self.order[row]
+        stored_message = StoredMessage(self.mbox_paths[self.mbox_path_column[row]], self.offset_column[row],
+                                       self.length_column[row])
+        return (self.senders[self.sender_column[row]], self.timestamp_column[row], self.subject(row),
+                ItemMetaData(stored_message))
+
+    def __setitem__(self, row, value):
+        from_text, timestamp, subject, meta_data = value
+        row = self.order[row]
+        self.sender_column[row] = self.intern(self.senders, self.sender_ids, from_text)
+        self.timestamp_column[row] = timestamp
+        # the previous subject stays in the buffer, rows are rarely replaced
+        self.subject_starts[row], self.subject_lengths[row] = self.store_subject(subject)
+        self.mbox_path_column[row] = self.intern(self.mbox_paths, self.mbox_path_ids,
+                                                 meta_data.stored_message.mbox_path)
+        self.offset_column[row] = meta_data.stored_message.offset
+        self.length_column[row] = meta_data.stored_message.length
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def extend(self, rows):
+        for from_text, timestamp, subject, meta_data in rows:
+            self.order.append(len(self.timestamp_column))
+            self.sender_column.append(self.intern(self.senders, self.sender_ids, from_text))
+            self.timestamp_column.append(timestamp)
+            start, length = self.store_subject(subject)
+            self.subject_starts.append(start)
+            self.subject_lengths.append(length)
+            self.mbox_path_column.append(self.intern(self.mbox_paths, self.mbox_path_ids,
+                                                     meta_data.stored_message.mbox_path))
+            self.offset_column.append(meta_data.stored_message.offset)
+            self.length_column.append(meta_data.stored_message.length)
+
+    def value(self, row, column):
+        """
+        A single cell, without building the row
+        """
+        if column == 0:
+            return self.senders[self.sender_column[self.order[row]]]
+        if column == INDEX_DATE:
+            return self.timestamp_column[self.order[row]]
+        if column == 2:
+            return self.subject(self.order[row])
+        return self[row][column]
+
+    def subject(self, row):
+        """
+        :param row: position in the columns, not in the table
+        """
+        start = self.subject_starts[row]
+        return self.subject_buffer[start:start + self.subject_lengths[row]].decode('utf-8', 'surrogatepass')
+
+    def sort(self, column, reverse=False):
+        """
+        Reorders the rows by comparing only the column's values
+        """
+        if column == 0:
+            # senders are compared by their rank among the interned ones
+            ranks = array.array('i', [0]) * len(self.senders)
+            for rank, sender_id in enumerate(sorted(range(len(self.senders)), key=self.senders.__getitem__)):
+                ranks[sender_id] = rank
+            key = array.array('i', map(ranks.__getitem__, self.sender_column)).__getitem__
+        elif column == INDEX_DATE:
+            key = self.timestamp_column.__getitem__
+        elif column == 2:
+            # UTF-8 bytes sort like the strings they encode
+            buffer = memoryview(self.subject_buffer)
+            key = [buffer[start:start + length].tobytes()
+                   for start, length in zip(self.subject_starts, self.subject_lengths)].__getitem__
+        else:
+            return
+
+        self.order = array.array('i', sorted(self.order, key=key, reverse=reverse))
+
+    def end_of_mbox(self, mbox_path):
+        """
+        :return: where the last row's message of the mailbox ends, 0 without any
+        """
+        mbox_path_id = self.mbox_path_ids.get(mbox_path)
+        return max([offset + length for path_id, offset, length
+                    in zip(self.mbox_path_column, self.offset_column, self.length_column)
+                    if path_id == mbox_path_id] or [0])
+
+    def entries(self, mbox_path):
+        """
+        The mailbox's rows as appstate log entries, see AppStateLog.entry(), in the order they were added
+        """
+        mbox_path_id = self.mbox_path_ids.get(mbox_path)
+        return [[self.offset_column[row], self.length_column[row], self.senders[self.sender_column[row]],
+                 self.timestamp_column[row], self.subject(row)]
+                for row in range(len(self.timestamp_column)) if self.mbox_path_column[row] == mbox_path_id]
+
+    def store_subject(self, subject):
+        encoded = str(subject).encode('utf-8', 'surrogatepass')
+        start = len(self.subject_buffer)
+        self.subject_buffer += encoded
+        return start, len(encoded)
+
+    @staticmethod
+    def intern(values, ids, value):
+        value_id = ids.get(value)
+        if value_id is None:
+            value_id = ids[value] = len(values)
+            values.append(value)
+        return value_id
+
+
+tableview_data = MessageTable()
+
+
 class EmailTableModel(QtCore.QAbstractTableModel):
     header_labels = ['            From            ', '            Date            ', 'Subject']
 
@@ -1232,24 +2076,21 @@ class EmailTableModel(QtCore.QAbstractTableModel):
             return QtCore.QVariant()
         elif role == QtCore.Qt.TextAlignmentRole:
             return QtCore.Qt.AlignLeft
-        elif qModelIndex.isValid() and role == QtCore.Qt.DecorationRole:
-            row = qModelIndex.row()
-            column = qModelIndex.column()
-            value = None
-            try:
-                value = self.arraydata[row][column]
-            except IndexError:
-                return
         elif qModelIndex.isValid() and role == QtCore.Qt.DisplayRole:
-            row = qModelIndex.row()
             column = qModelIndex.column()
             try:
-                value = self.arraydata[row][column]
+                value = self.arraydata.value(qModelIndex.row(), column)
             except IndexError:
                 return
+            if column == INDEX_DATE:
+                # unlike fromTime_t(), takes dates before 1970 and after 2106; an exception here would abort the app
+                try:
+                    return QtCore.QDateTime.fromSecsSinceEpoch(value)
+                except (OverflowError, TypeError):
+                    return QtCore.QVariant()
             return value
 
-        return QtCore.QVariant(self.arraydata[qModelIndex.row()][qModelIndex.column()])
+        return QtCore.QVariant()
 
     def setData(self, index, value, role=QtCore.Qt.EditRole):
         if role == QtCore.Qt.EditRole:
@@ -1272,9 +2113,19 @@ class EmailTableModel(QtCore.QAbstractTableModel):
         return QtCore.QAbstractTableModel.headerData(self, section, orientation, role)
 
     def insertRows(self, position, item, parent=QtCore.QModelIndex()):
+        return self.appendRows([item])  # Item must be an array
+
+    def appendRows(self, rows):
+        """
+        Appends rows at the end of the table, announcing only the new range to the views,
+        so selection, scroll position and the existing rows' geometry are kept
+        """
+        if not rows:
+            return False
 
-        self.beginInsertRows(QtCore.QModelIndex(), len(self.arraydata), len(self.arraydata) + 1)
-        self.arraydata.append(item)  # Item must be an array
+        first = len(self.arraydata)
+        self.beginInsertRows(QtCore.QModelIndex(), first, first + len(rows) - 1)
+        self.arraydata.extend(rows)
         self.endInsertRows()
         return True
 
@@ -1284,8 +2135,7 @@ class EmailTableModel(QtCore.QAbstractTableModel):
         """
         self.sendSignalLayoutAboutToBeChanged()
 
-        sorted_data = sorted(self.arraydata, key=operator.itemgetter(ncol), reverse=order)
-        self.arraydata[:] = sorted_data[:]
+        self.arraydata.sort(ncol, reverse=bool(order))
         self.sendSignalLayoutChanged()
         self.last_saved_sort_column = ncol
         self.last_saved_sort_order = order
@@ -1293,126 +2143,466 @@ class EmailTableModel(QtCore.QAbstractTableModel):
     def flags(self, index):
         return QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsEditable | QtCore.Qt.ItemIsSelectable
 
-class SmtpMailsinkServer(smtpd.SMTPServer):
-    __version__ = 'Python SMTP Mail Sink version 0.2'
-
-    def __init__(self, *args, **kwargs):
-        if DEBUG_SMTP:
-            smtpd.DEBUGSTREAM = sys.stdout
-            smtpd.SMTPServer.debug = True
-        smtpd.SMTPServer.__init__(self, *args, **kwargs)
-        self.mailboxFilePath = None
-        self.queue = None
+class Attachment:
+    def __init__(self, filename, binary_data, content_type=None, content_disposition=None):
+        self.filename = filename
+        self.content_type = content_type
+        self.binary_data = binary_data
+        self.content_disposition = content_disposition
 
-    def setQueue(self, mailQueue):
-        self.queue = mailQueue
 
-    def set_mbox_file_path(self, mailboxFilePath):
-        self.mailboxFilePath = mailboxFilePath
+class ItemMetaData:
+    """
+    Hidden table column: where the message is, it is parsed only when displayed
+    """
+    __slots__ = ('stored_message',)
 
-    def process_message(self, peer, mailfrom, rcpttos, data):
+    def __init__(self, stored_message):
+        """
+        :type stored_message: StoredMessage
+        """
+        self.stored_message = stored_message
 
-        LOG.info("processing new message from %s", mailfrom)
+    def get_message(self):
+        return PARSED_MESSAGES.get(self.stored_message)
 
-        if self.mailboxFilePath is not None:
-            mbox_write_item(mbox_path=self.mailboxFilePath, from_text=mailfrom, data=data)
+    def get_raw_message(self):
+        return b''.join(self.stored_message.read_chunks())
 
-        # print "Adding data to queue %s" % str(self.queue)
-        self.queue.put(data)
-        # print "Finish adding data to queue"
+    def get_rendered_message(self):
+        """
+        :return: (headers and body as HTML, attachments)
+        """
+        return RENDERED_MESSAGES.get(self.stored_message)
 
 
-class PortAlreadyInUseException(Exception):
-    pass
+class MessageRenderer(QtCore.QObject):
+    """
+    Renders messages for display on a pool of worker threads, see RenderedMessageCache. Only the latest request
+    counts: requests still waiting when another one comes in are skipped, and results are delivered by signal
+    with their request id, so that the receiver can drop those of a selection that moved on.
 
+    prefetch() renders messages into the cache on a thread of its own, one at a time and only while no request
+    is being rendered. A new prefetch() abandons the previous one.
+    """
+    rendered = QtCore.pyqtSignal(int, object, object)  # request id, headers and body as HTML, attachments
+    failed = QtCore.pyqtSignal(int, object)  # request id, exception
+
+    def __init__(self, workers=RENDER_WORKERS):
+        super(MessageRenderer, self).__init__()
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='render')
+        self.prefetch_executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='prefetch')
+        self.request_id = 0
+        self.prefetch_id = 0
+        self.pending_requests = 0
+        self.pending_lock = threading.Lock()
+        self.idle = threading.Event()  # set while no request is waiting or being rendered
+        self.idle.set()
+
+    def request(self, stored_message):
+        """
+        :return: the request id
+        """
+        self.request_id += 1
+        with self.pending_lock:
+            self.pending_requests += 1
+            self.idle.clear()
+        self.executor.submit(self.render, self.request_id, stored_message)
+        return self.request_id
+
+    def prefetch(self, stored_messages):
+        self.prefetch_id += 1
+        if stored_messages:
+            self.prefetch_executor.submit(self.render_ahead, self.prefetch_id, stored_messages)
+
+    def render_ahead(self, prefetch_id, stored_messages):
+        for stored_message in stored_messages:
+            # requests go first, the user waits for those
+            self.idle.wait()
+            if prefetch_id != self.prefetch_id:
+                return  # the user jumped elsewhere
+            try:
+                RENDERED_MESSAGES.get(stored_message)
+            except Exception as e:
+                LOG.debug('Error prefetching message at %d', stored_message.offset, exc_info=e)
 
-class SmtpMailsink(threading.Thread):
-    TIME_TO_WAIT_BETWEEN_CHECKS_TO_STOP_SERVING = 0.001
+    def cancel(self):
+        self.request_id += 1
 
-    def __init__(self, host="localhost", port=DEFAULT_PORT, mailboxFilePath=None, threadName=None, mailQueue=None):
-        self.queue = mailQueue
-        self.throwExceptionIfAddressIsInUse(host, port)
-        self.initializeThread(threadName)
-        self.initializeSmtpMailsinkServer(host, port, mailboxFilePath)
+    def is_current(self, request_id):
+        return request_id == self.request_id
 
-    def throwExceptionIfAddressIsInUse(self, host, port):
-        testSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        testSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,
-                              testSocket.getsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR) | 1)
+    def render(self, request_id, stored_message):
         try:
-            testSocket.bind((host, port))
-        except Exception as e:
-            raise PortAlreadyInUseException(e)
+            if not self.is_current(request_id):
+                return  # the selection moved on while this was waiting
+
+            try:
+                message_html, attachments = RENDERED_MESSAGES.get(stored_message)
+            except Exception as e:
+                LOG.error('Error rendering message at %d', stored_message.offset, exc_info=e)
+                self.failed.emit(request_id, e)
+                return
+
+            self.rendered.emit(request_id, message_html, attachments)
         finally:
-            testSocket.close()
-
-    def initializeThread(self, threadName):
-        self._stopevent = threading.Event()
-        self.threadName = threadName
-        if self.threadName is None:
-            self.threadName = SmtpMailsink.__class__
-        threading.Thread.__init__(self, name=self.threadName)
-
-    def initializeSmtpMailsinkServer(self, host, port, mailboxFilePath):
-        self.smtpMailsinkServer = SmtpMailsinkServer((host, port), None)
-        self.smtpMailsinkServer.setQueue(self.queue)
-        self.init_mailbox(mailboxFilePath)
-        smtpd.__version__ = SmtpMailsinkServer.__version__
-
-    def init_mailbox(self, mailboxFilePath=None):
-        self.mailboxFilePath = mailboxFilePath
-        #        if self.mailboxFilePath is None:
-        #            self.mailboxFilePath = StringIO.StringIO()
-        self.smtpMailsinkServer.set_mbox_file_path(self.mailboxFilePath)
-        if not os.path.exists(self.mailboxFilePath):
-            with open(self.mailboxFilePath, 'ab') as mbox:
-                mbox.write('Started on %s' % QtCore.QDateTime.currentDateTime().toString())
-
-    def getMailboxContents(self):
-        return self.mailboxFilePath.getvalue()
-
-    def getMailboxFile(self):
-        return self.mailboxFilePath
+            with self.pending_lock:
+                self.pending_requests -= 1
+                if not self.pending_requests:
+                    self.idle.set()
 
-    def run(self):
-        while not self._stopevent.isSet():
-            asyncore.loop(timeout=SmtpMailsink.TIME_TO_WAIT_BETWEEN_CHECKS_TO_STOP_SERVING, count=1)
+    def shutdown(self):
+        self.cancel()
+        self.prefetch_id += 1
+        self.idle.set()
+        self.executor.shutdown(wait=False)
+        self.prefetch_executor.shutdown(wait=False)
 
-    def stop(self, timeout=None):
-        LOG.info("Stopping SMTP server...")
-        self._stopevent.set()
-        threading.Thread.join(self, timeout)
-        self.smtpMailsinkServer.close()
-        LOG.info("Stopped.")
 
+class ParsedMessageCache:
+    """
+    The last few displayed messages, attachments included, so that going back and forth does not parse them again
+    """
 
-class Attachment:
-    def __init__(self, filename, binary_data, content_type=None, content_disposition=None):
-        self.filename = filename
-        self.content_type = content_type
-        self.binary_data = binary_data
-        self.content_disposition = content_disposition
+    def __init__(self, max_size=PARSED_MESSAGE_CACHE_SIZE):
+        self.max_size = max_size
+        self.messages = collections.OrderedDict()
+        self.lock = threading.Lock()  # used by the GUI and the MessageRenderer
 
+    def get(self, stored_message):
+        """
+        :type stored_message: StoredMessage
+        :rtype: email.message.Message
+        """
+        key = (stored_message.mbox_path, stored_message.offset)
+        with self.lock:
+            message = self.messages.get(key)
+            if message is not None:
+                self.messages.move_to_end(key)
+                return message
+
+        message = EmailParser.parse_stored_message(stored_message)
+
+        with self.lock:
+            self.messages[key] = message
+            if len(self.messages) > self.max_size:
+                self.messages.popitem(last=False)
+
+        return message
+
+    def clear(self):
+        with self.lock:
+            self.messages.clear()
+
+
+PARSED_MESSAGES = ParsedMessageCache()
+
+
+class RenderedMessageCache:
+    """
+    Displayed messages as HTML, with their attachments, so that going back and forth neither decodes their parts
+    nor cleans their HTML again. Limited by count and by size, whichever is reached first drops the least recently
+    displayed ones. The HTML cleaning settings are part of the key.
+    """
+
+    def __init__(self, max_size=RENDERED_MESSAGE_CACHE_SIZE, max_bytes=RENDERED_MESSAGE_CACHE_BYTES):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.messages = collections.OrderedDict()
+        self.size_in_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()  # used by the GUI and the MessageRenderer
+
+    def get(self, stored_message, render=True):
+        """
+        :type stored_message: StoredMessage
+        :param render: False to only look the message up
+        :return: (headers and body as HTML, attachments), None if not rendered yet and render is False
+        """
+        key = (stored_message.mbox_path, stored_message.offset,
+               EmailParser.cleaning_is_enabled and EmailParser.cleaning_profile)
+
+        with self.lock:
+            entry = self.messages.get(key)
+            if entry is not None:
+                self.hits += 1
+                self.messages.move_to_end(key)
+                return entry[0], entry[1]
+            if not render:
+                return None
+            self.misses += 1
+
+        # rendered outside the lock, so that the pool's workers render in parallel
+        message_html, attachments = EmailParser.render_email(PARSED_MESSAGES.get(stored_message))
+        size = len(message_html) + sum(len(attachment.binary_data or b'') for attachment in attachments or [])
+
+        with self.lock:
+            if key not in self.messages:
+                self.messages[key] = (message_html, attachments, size)
+                self.size_in_bytes += size
+            while len(self.messages) > 1 and (len(self.messages) > self.max_size or
+                                              self.size_in_bytes > self.max_bytes):
+                self.size_in_bytes -= self.messages.popitem(last=False)[1][2]
+
+            LOG.debug('Rendered message cache: %d hits, %d misses, %d messages, %d bytes',
+                      self.hits, self.misses, len(self.messages), self.size_in_bytes)
+
+        return message_html, attachments
+
+    def clear(self):
+        with self.lock:
+            self.messages.clear()
+            self.size_in_bytes = 0
+
+
+RENDERED_MESSAGES = RenderedMessageCache()
 
-class ItemMetaData:
-    def __init__(self, message, headers):
-        self.message = message
-        self.headers = headers
 
+class AppStateLog:
+    """
+    The table as an append-only log, so that startup needs neither the mbox index nor the messages' headers,
+    and neither startup nor exit rewrite anything. A version line with the mbox it was built from, then batches
+    of one JSON line per row: [offset, length, From, timestamp, Subject], each batch closed by a checkpoint line
+    recording the mbox's identity, size and mtime, and a checksum of the bytes before the end of the last row.
+
+    Replaying gives the table as it is for an unchanged mbox, along with where to scan for new messages
+    for one that only grew, and fails otherwise, so that the mailbox gets reindexed. A batch cut short
+    by a crash is dropped. Checkpoints pile up, compact() rewrites the log in the background.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mbox_path = None  # set once the log matches the table
+        self.log_file = None
+        self.lock = threading.Lock()
+        self.end = 0
+        self.row_count = 0
+        self.checkpoint_count = 0
+        self.compaction = None
+        self.pending_lines = []  # appended while compacting
+
+    def replay(self, mbox_path):
+        """
+        Reads the log and keeps it open for appending
+        :return: (table rows, offset to scan for messages appended since or None if the mbox did not change)
+        :raises ValueError: when the log does not match the mbox any more
+        """
+        header, entries, checkpoint, checkpoint_count, valid_size = self.read_log()
+        if header is None:
+            raise ValueError('Appstate was saved by an older version')
+        if header['mbox_path'] != os.path.abspath(mbox_path):
+            raise ValueError('Appstate belongs to mailbox %s' % header['mbox_path'])
+        position = self.validate(checkpoint, mbox_path)
+
+        with self.lock:
+            self.log_file = open(self.path, 'r+', encoding='utf-8')
+            # drops a batch cut short by a crash
+            self.log_file.truncate(valid_size)
+            self.log_file.seek(valid_size)
+            self.mbox_path = mbox_path
+            self.end = checkpoint['end']
+            self.row_count = len(entries)
+            self.checkpoint_count = checkpoint_count
+
+        return [self.to_row(mbox_path, entry) for entry in entries], position
+
+    def append(self, rows):
+        lines = []
+        end = 0
+        for row in rows:
+            entry = self.entry(row)
+            if row[INDEX_HIDDEN_METADATA].stored_message.mbox_path == self.mbox_path:
+                lines.append(self.entry_line(entry))
+                end = max(end, entry[0] + entry[1])
+        if not lines:
+            return
 
-def mbox_write_item(mbox_path, from_text, data):
-    try:
-        with open(mbox_path, 'a') as mbox_file:
-            mbox_file.write("From %s\n" % from_text)
-            mbox_file.write(data)
-            mbox_file.write("\n\n")
-            LOG.debug('From: %s', from_text)
+        with self.lock:
+            if self.mbox_path is None:
+                return  # nothing valid to append to, the next compact() writes the table
+            self.end = max(self.end, end)
+            lines.append(self.checkpoint_line(self.mbox_path, self.end))
+            self.row_count += len(lines) - 1
+            self.checkpoint_count += 1
+            if self.compaction:
+                self.pending_lines.extend(lines)
+            else:
+                self.log_file.write(''.join(lines))
+                self.log_file.flush()
+
+    def needs_compaction(self):
+        return self.checkpoint_count > max(APPSTATE_COMPACT_MIN_CHECKPOINTS, self.row_count)
 
-            if DEBUG_APP:
-                LOG.debug(data)
-    except Exception as e:
-        LOG.error('Error processing mail item!', exc_info=e)
-        show_gui_error(e, error_text='Cannot write to mailbox %s! Please, check if file is writable.' % mbox_path)
+    def compact(self, entries=None, mbox_path=None):
+        """
+        Rewrites the log in a background thread, as one batch. Rows appended meanwhile are kept aside
+        and follow it in the new log
+        :param entries: the whole table, see entry(), to replace the log with, defaults to the log's rows
+        """
+        self.wait_for_compaction()
+
+        with self.lock:
+            if entries is not None:
+                self.mbox_path = mbox_path
+                self.end = max([offset + length for offset, length, __, __, __ in entries] or [0])
+                self.row_count = len(entries)
+            elif self.mbox_path is None:
+                return
+            self.checkpoint_count = 1
+            self.compaction = threading.Thread(target=self.run_compaction, name='appstate-compaction',
+                                               args=(entries, self.mbox_path, self.end))
+            self.compaction.daemon = True
+            self.compaction.start()
+
+    @timed
+    def run_compaction(self, entries, mbox_path, end):
+        try:
+            if entries is None:
+                if self.log_file is not None:
+                    with self.lock:
+                        self.log_file.flush()
+                __, entries, __, __, __ = self.read_log()
+
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as log_file:
+                log_file.write(self.header_line(mbox_path))
+                for entry in entries:
+                    log_file.write(self.entry_line(entry))
+                log_file.write(self.checkpoint_line(mbox_path, end))
+
+                with self.lock:
+                    log_file.write(''.join(self.pending_lines))
+                    log_file.close()
+                    if self.log_file is not None:
+                        self.log_file.close()
+                    os.replace(self.path + '.tmp', self.path)
+                    self.log_file = open(self.path, 'a', encoding='utf-8')
+                    del self.pending_lines[:]
+                    self.compaction = None
+        except (OSError, ValueError) as e:
+            LOG.error('Cannot compact appstate %s, it is dropped', self.path, exc_info=e)
+            # the rows kept aside are lost, the next start reindexes the mailbox instead
+            with self.lock:
+                if self.log_file is not None:
+                    self.log_file.close()
+                    self.log_file = None
+                self.mbox_path = None
+                del self.pending_lines[:]
+                self.compaction = None
+                for path in (self.path, self.path + '.tmp'):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def wait_for_compaction(self):
+        compaction = self.compaction
+        if compaction is not None:
+            compaction.join()
+
+    def close(self):
+        self.wait_for_compaction()
+        with self.lock:
+            if self.log_file is not None:
+                self.log_file.close()
+                self.log_file = None
+            self.mbox_path = None
+
+    def read_log(self):
+        """
+        :return: (header or None if unusable, entries up to the last checkpoint, last checkpoint,
+                  number of checkpoints, size of the log up to the last one)
+        """
+        entries = []
+        checkpoint = None
+        checkpoint_count = 0
+        valid_size = 0
+        try:
+            with open(self.path, 'rb') as log_file:
+                header = json.loads(log_file.readline())
+                if not isinstance(header, dict) or header.get('version') != APPSTATE_VERSION:
+                    return None, [], None, 0, 0
+
+                batch = []
+                for line in log_file:
+                    if not line.endswith(b'\n'):
+                        break  # cut short by a crash
+                    record = json.loads(line)
+                    if isinstance(record, dict):
+                        entries.extend(batch)
+                        batch = []
+                        checkpoint = record
+                        checkpoint_count += 1
+                        valid_size = log_file.tell()
+                    else:
+                        batch.append(record)
+        except ValueError:
+            if checkpoint is None:
+                return None, [], None, 0, 0
+
+        return header, entries, checkpoint, checkpoint_count, valid_size
+
+    def validate(self, checkpoint, mbox_path):
+        """
+        :return: None if the mbox is unchanged, the end of the logged rows if messages were appended to it
+        """
+        if checkpoint is None:
+            raise ValueError('Appstate has no complete batch')
+
+        stat = os.stat(mbox_path)
+        if (stat.st_dev, stat.st_ino) != (checkpoint['device'], checkpoint['inode']):
+            raise ValueError('Mailbox was replaced')
+        if stat.st_size < checkpoint['size']:
+            raise ValueError('Mailbox was truncated')
+        if stat.st_size == checkpoint['size'] and stat.st_mtime_ns != checkpoint['mtime']:
+            raise ValueError('Mailbox was rewritten')
+        if mbox_tail_checksum(mbox_path, checkpoint['end']) != checkpoint['tail_checksum']:
+            raise ValueError('Mailbox was rewritten')
+
+        # the empty line after the last message is not part of it
+        return checkpoint['end'] if stat.st_size > checkpoint['end'] + len(b'\n\n') else None
+
+    def header_line(self, mbox_path):
+        return json.dumps({'version': APPSTATE_VERSION, 'mbox_path': os.path.abspath(mbox_path)}) + '\n'
+
+    def checkpoint_line(self, mbox_path, end):
+        # rows received over SMTP may still be buffered by our own MboxWriter
+        flush_mbox_writes(mbox_path, end)
+        stat = os.stat(mbox_path)
+        return json.dumps({'device': stat.st_dev, 'inode': stat.st_ino, 'size': stat.st_size,
+                           'mtime': stat.st_mtime_ns, 'end': end,
+                           'tail_checksum': mbox_tail_checksum(mbox_path, end)}) + '\n'
+
+    def entry_line(self, entry):
+        return json.dumps(entry, ensure_ascii=False) + '\n'
+
+    @staticmethod
+    def entry(row):
+        from_text, timestamp, subject, meta_data = row
+        return [meta_data.stored_message.offset, meta_data.stored_message.length, from_text, timestamp, subject]
+
+    @staticmethod
+    def to_row(mbox_path, entry):
+        offset, length, from_text, timestamp, subject = entry
+        return from_text, timestamp, subject, ItemMetaData(StoredMessage(mbox_path, offset, length))
+
+
+def mbox_tail_checksum(mbox_path, end):
+    """
+    CRC32 of the APPSTATE_TAIL_BYTES before end
+    """
+    with open(mbox_path, 'rb') as mbox_file:
+        start = max(0, end - APPSTATE_TAIL_BYTES)
+        mbox_file.seek(start)
+        return zlib.crc32(mbox_file.read(end - start))
+
+
+def html_truncation_point(message_html, limit):
+    """
+    Where to cut the HTML at limit or before, without splitting a tag
+    """
+    tag_start = message_html.rfind('<', 0, limit)
+    if tag_start >= 0 and message_html.find('>', tag_start, limit) < 0:
+        return tag_start
+    return limit
 
 
 def create_folder_if_not_exists(folder_path=None, error_message="CANNOT CREATE FOLDER: %s!"):
@@ -1440,45 +2630,9 @@ def show_gui_error(e, error_text=''):
     QtWidgets.QMessageBox.warning(None, APPNAME, full_error)
 
 
-@timed
-def save_state(data, file_handle):
-    pickle.dump(data, file_handle, protocol=pickle.HIGHEST_PROTOCOL)
-
-
-@timed
-def restore_state(file_handle):
-    return pickle.load(file_handle)
-
-
-def init_logging(log_file_dir=None, log_to_stdout=True, log_to_file=False):
-    global LOG
-    LOG = logging.getLogger("cutepiesmtpdaemon")
-    LOG.setLevel(logging.DEBUG)
-
-    if log_to_stdout or log_to_file:
-        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    else:
-        return
-
-    if log_to_file:
-        if not log_file_dir:
-            log_file_dir = '.'
-
-        log_file_path = os.path.join(log_file_dir, LOG_FILE_NAME)
-        print('Logging to file', log_file_path)
-        file_handler = logging.FileHandler(log_file_path)
-        file_handler.setLevel(logging.DEBUG)
-        file_handler.setFormatter(formatter)
-        LOG.addHandler(file_handler)
-
-    if log_to_stdout:
-        stdout_handler = logging.StreamHandler()
-        stdout_handler.setLevel(logging.DEBUG)
-        stdout_handler.setFormatter(formatter)
-        LOG.addHandler(stdout_handler)
-
-
 def main():
+    # the SMTP worker pool and parallel scans spawn processes, which a frozen executable has to recognize
+    multiprocessing.freeze_support()
     app = QtWidgets.QApplication(sys.argv)
     mainWin = MainWindow()
     mainWin.show()
@@ -19,7 +19,7 @@ cp $appname.sh $appname/usr/bin/$appname
 chmod +x $appname/usr/bin/$appname
 cp $appname.desktop $appname/usr/share/applications/$appname.desktop
 cp $srcdir/icons/$appname.png $appname/usr/share/pixmaps/$appname.png
-cp $srcdir/{cutepiesmtpdaemon_py3.py,valid_encodings.py,cutesmtp_icons.py,LICENSE.txt} $appname/usr/share/$appname/
+cp $srcdir/{cutepiesmtpdaemon_py3.py,smtp_mailsink.py,valid_encodings.py,cutesmtp_icons.py,LICENSE.txt} $appname/usr/share/$appname/
 
 dpkg --build $appname/ $appname-$last_version.deb
 
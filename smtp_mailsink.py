@@ -0,0 +1,1892 @@
+#!/usr/bin/env python3
+# -*- coding: ascii -*-
+"""
+Capture side of Cute Pie SMTP Daemon: SMTP engines, the message sink and mbox storage.
+
+Has no PyQt dependency, so it can run headless:
+
+    python smtp_mailsink.py --host 127.0.0.1 --port 1025 --mbox mailbox.mbox
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import importlib.util
+import io
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import queue
+import re
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+from time import sleep, time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: mailboxes are only coordinated between the threads of one process
+
+__all__ = ['SmtpMailsinkServer',
+           'SmtpMailsink',
+           'SmtpMailsinkPool',
+           'StoredMessage',
+           'MboxWriter',
+           'MboxIndex',
+           'ScanCancelledException',
+           'mbox_write_item',
+           'flush_mbox_writes',
+           'load_mbox_index',
+           'is_last_message_settled']
+
+DEBUG_SMTP = True
+DEBUG_APP = False
+DEFAULT_PORT = 1025
+DEFAULT_MBOX_PATH = 'mailbox.mbox'
+LOG_FILE_NAME = 'app.log'
+LOGGER_NAME = 'cutepiesmtpdaemon'
+SMTP_ENGINE_ASYNCIO = 'asyncio'
+SMTP_ENGINE_ASYNCORE = 'asyncore'
+DEFAULT_SMTP_ENGINE = SMTP_ENGINE_ASYNCIO
+DATA_SIZE_LIMIT = 33554432  # same as smtpd.DATA_SIZE_DEFAULT
+SPOOL_MEMORY_LIMIT = 1024 * 1024  # messages above this size are spooled to disk while they arrive
+COPY_CHUNK_SIZE = 64 * 1024
+DEFAULT_HIGH_WATER_MARK = 1000  # queued messages before new SMTP transactions are deferred with a 4xx reply
+
+MBOX_DURABILITY_NONE = 'none'  # appends stay in the process buffer until a reader needs them or it fills up
+MBOX_DURABILITY_FLUSH = 'flush'  # each group commit hands the appends to the OS
+MBOX_DURABILITY_FSYNC = 'fsync'  # each group commit also waits until they are on disk
+MBOX_DURABILITY_POLICIES = (MBOX_DURABILITY_NONE, MBOX_DURABILITY_FLUSH, MBOX_DURABILITY_FSYNC)
+DEFAULT_MBOX_DURABILITY = MBOX_DURABILITY_FLUSH
+DEFAULT_COMMIT_MESSAGES = 64  # group commit after this many appends...
+DEFAULT_COMMIT_MILLISECS = 50  # ...or this long after the first uncommitted one, whichever comes first
+
+INDEX_SUFFIX = '.idx'  # sidecar next to the mbox, see MboxIndex
+INDEX_VERSION = 1
+INDEX_HEADERS = ('From', 'To', 'Subject', 'Date', 'Reply-To', 'X-Mailer')  # kept raw, decoding is up to the reader
+HEADER_BLOCK_LIMIT = 64 * 1024  # header bytes looked at for the index, the rest of a huge header is ignored
+HEADER_READ_SIZE = 4 * 1024  # headers are read in steps of this, usually one is enough
+INDEX_HEADER_NAMES = {name.lower().encode(): name for name in INDEX_HEADERS}
+INDEX_HEADER_LINE = re.compile(b'^(%s)[ \t]*:(.*(?:\r?\n[ \t].*)*)' % b'|'.join(map(re.escape, INDEX_HEADER_NAMES)),
+                               re.IGNORECASE | re.MULTILINE)
+PARALLEL_SCAN_MIN_BYTES = 64 * 1024 * 1024  # below this, starting scan processes costs more than it saves
+
+# mboxrd: a message line starting with any number of ">" and "From " gets one more ">" in the mbox, and loses it
+# again when read, so that only real separators start with "From ". Messages are separated by an empty line.
+MBOX_SEPARATOR = b'\n\nFrom '
+ESCAPE_FROM_LINE = (re.compile(b'\n(>*From )'), b'\n>\\1')
+UNESCAPE_FROM_LINE = (re.compile(b'\n>(>*From )'), b'\n\\1')
+
+# appends from the SMTP engine, the pool writer and the GUI must not interleave
+MBOX_WRITE_LOCK = threading.Lock()
+MBOX_WRITERS = {}  # real mbox path -> open MboxWriter, guarded by MBOX_WRITE_LOCK
+MBOX_INDEX_LOCKS = {}  # real mbox path -> MboxIndexLock, guarded by MBOX_INDEX_LOCKS_LOCK
+MBOX_INDEX_LOCKS_LOCK = threading.Lock()
+SCAN_CANCEL_POLL_SECS = 0.1  # how often a parallel scan waiting for its workers checks for cancellation
+MBOX_LOCK_POLL_SECS = 0.01  # how often a process waiting for the flock() of an mbox or its index tries again
+MBOX_LOCK_TIMEOUT_SECS = 1.0  # how long an append waits for readers checking whether the mbox is being written
+
+LOG = logging.getLogger(LOGGER_NAME)
+
+
+class SmtpMailsinkServer:
+    """
+    Engine independent message sink. Streaming engines write DATA into begin_message() as it arrives and
+    finish with end_message(); engines that buffer whole messages call process_message().
+    The queue is fed StoredMessage locators, never the message bytes.
+    """
+    __version__ = 'Python SMTP Mail Sink version 0.2'
+
+    def __init__(self):
+        self.mailboxFilePath = None
+        self.mboxWriter = None
+        self.queue = None
+        self.highWaterMark = None
+        self.acceptedCount = 0
+        self.deferredCount = 0
+        self.queueListener = None
+
+    def setQueue(self, mailQueue):
+        self.queue = mailQueue
+
+    def set_queue_listener(self, queueListener):
+        """
+        :param queueListener: callable invoked, on the SMTP thread, after each message put on the queue
+        """
+        self.queueListener = queueListener
+
+    def set_mbox_file_path(self, mailboxFilePath):
+        self.mailboxFilePath = mailboxFilePath
+
+    def set_mbox_writer(self, mboxWriter):
+        """
+        :type mboxWriter: MboxWriter
+        """
+        self.mboxWriter = mboxWriter
+
+    def set_high_water_mark(self, highWaterMark):
+        """
+        :param highWaterMark: queue depth at which new messages are deferred, None for no limit
+        """
+        self.highWaterMark = highWaterMark
+
+    def queue_depth(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def is_overloaded(self):
+        return self.highWaterMark is not None and self.queue_depth() >= self.highWaterMark
+
+    def admit_message(self):
+        """
+        Asked before a message is received: False means the consumer fell behind and the client
+        has to be told to try again later
+        """
+        if self.is_overloaded():
+            self.deferredCount += 1
+            return False
+        return True
+
+    def get_metrics(self):
+        return {'queue_depth': self.queue_depth(),
+                'high_water_mark': self.highWaterMark,
+                'accepted': self.acceptedCount,
+                'deferred': self.deferredCount}
+
+    def begin_message(self, peer, mailfrom, rcpttos):
+        return SpooledMessage(peer, mailfrom, rcpttos, tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_LIMIT))
+
+    def end_message(self, message):
+        """
+        Stores a completely received message
+        :type message: SpooledMessage
+        :return: SMTP status, None means 250 OK
+        """
+        LOG.info("processing new message from %s", message.mailfrom)
+
+        try:
+            if self.mailboxFilePath is None:
+                return
+
+            message.spool_file.seek(0)
+            if self.mboxWriter is not None:
+                stored_message = self.mboxWriter.append_file(message.mailfrom, message.spool_file)
+            else:
+                stored_message = mbox_write_file(self.mailboxFilePath, message.mailfrom, message.spool_file)
+        finally:
+            message.discard()
+
+        self.acceptedCount += 1
+
+        # headless mode runs without a consumer, so there is no queue to feed
+        if self.queue is not None:
+            self.queue.put(stored_message)
+
+            if self.queueListener is not None:
+                self.queueListener()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        message = self.begin_message(peer, mailfrom, rcpttos)
+        message.write(data)
+        return self.end_message(message)
+
+
+class SpooledMessage:
+    """
+    DATA of a message being received, written chunk by chunk to a spool file (in memory while small)
+    """
+
+    def __init__(self, peer, mailfrom, rcpttos, spool_file, spool_path=None):
+        self.peer = peer
+        self.mailfrom = mailfrom
+        self.rcpttos = rcpttos
+        self.spool_file = spool_file
+        self.spool_path = spool_path
+        self.size = 0
+
+    def write(self, chunk):
+        self.spool_file.write(chunk)
+        self.size += len(chunk)
+
+    def discard(self):
+        self.spool_file.close()
+        if self.spool_path is not None and os.path.exists(self.spool_path):
+            os.remove(self.spool_path)
+
+
+class StoredMessage:
+    """
+    Locates a message in the mbox file, passed around instead of the message itself
+    """
+    __slots__ = ('mbox_path', 'offset', 'length', 'headers')
+
+    def __init__(self, mbox_path, offset, length, headers=None):
+        """
+        :param headers: raw INDEX_HEADERS values when already known, see get_headers()
+        """
+        self.mbox_path = mbox_path
+        self.offset = offset
+        self.length = length
+        self.headers = headers
+
+    def get_headers(self):
+        """
+        :return: dict of raw INDEX_HEADERS values, read from the mbox when not known yet
+        """
+        if self.headers is None:
+            chunks = self.read_chunks(HEADER_READ_SIZE)
+            try:
+                self.headers = parse_index_headers(read_header_block(chunks))
+            finally:
+                chunks.close()
+        return self.headers
+
+    def read_chunks(self, chunk_size=COPY_CHUNK_SIZE):
+        """
+        :return: generator of the message bytes, as received, in chunks of about chunk_size
+        """
+        flush_mbox_writes(self.mbox_path, self.offset + self.length)
+        return transform_line_starts(self.read_raw_chunks(chunk_size), UNESCAPE_FROM_LINE)
+
+    def read_raw_chunks(self, chunk_size=COPY_CHUNK_SIZE):
+        with open(self.mbox_path, 'rb') as mbox_file:
+            mbox_file.seek(self.offset)
+            remaining = self.length
+
+            while remaining > 0:
+                chunk = mbox_file.read(min(chunk_size, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+
+
+AsyncoreSmtpEngine = None  # defined by create_asyncore_engine()
+
+
+def create_asyncore_engine(sink, host, port, reuse_port=False):
+    """
+    Imports smtpd/asyncore only once the legacy engine is asked for: they are deprecated, warn when imported,
+    and are removed in Python 3.12
+    """
+    global AsyncoreSmtpEngine
+
+    if AsyncoreSmtpEngine is None:
+        import asyncore
+        import smtpd
+
+        class AsyncoreSmtpEngine(smtpd.SMTPServer):
+            """
+            Legacy engine: smtpd/asyncore polled in a loop until stop() is called
+            """
+            TIME_TO_WAIT_BETWEEN_CHECKS_TO_STOP_SERVING = 0.001
+
+            def __init__(self, sink, host, port, reuse_port=False):
+                if DEBUG_SMTP:
+                    smtpd.DEBUGSTREAM = sys.stdout
+                    smtpd.SMTPServer.debug = True
+                self.sink = sink
+                self.reuse_port = reuse_port
+                self._stopevent = threading.Event()
+                smtpd.SMTPServer.__init__(self, (host, port), None, data_size_limit=DATA_SIZE_LIMIT)
+                smtpd.__version__ = SmtpMailsinkServer.__version__
+
+            def set_reuse_addr(self):
+                smtpd.SMTPServer.set_reuse_addr(self)
+                if self.reuse_port:
+                    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+            def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+                # smtpd offers no hook before DATA, so overload is only detected once the message is in
+                if not self.sink.admit_message():
+                    return '451 Requested action aborted: ingest queue is full, try again later'
+                try:
+                    return self.sink.process_message(peer, mailfrom, rcpttos, data)
+                except MailboxWriteException:
+                    return '451 Requested action aborted: local error in processing'
+
+            def serve_forever(self):
+                while not self._stopevent.is_set():
+                    asyncore.loop(timeout=self.TIME_TO_WAIT_BETWEEN_CHECKS_TO_STOP_SERVING, count=1)
+
+            def stop(self):
+                self._stopevent.set()
+
+    return AsyncoreSmtpEngine(sink, host, port, reuse_port=reuse_port)
+
+
+class AsyncioSmtpSession:
+    """
+    A single client connection of the asyncio engine. Besides the smtpd.SMTPChannel command set it implements
+    the ESMTP extensions SIZE (RFC 1870), 8BITMIME (RFC 6152), PIPELINING (RFC 2920) and CHUNKING/BDAT (RFC 3030).
+    Message data stays bytes all the way to the sink.
+    """
+
+    def __init__(self, sink, reader, writer, fqdn):
+        """
+        :param fqdn: host name to greet with, looked up once by the engine since getfqdn() blocks
+        """
+        self.sink = sink
+        self.reader = reader
+        self.writer = writer
+        self.peer = writer.get_extra_info('peername')
+        self.fqdn = fqdn
+        self.seen_greeting = ''
+        self.extended_smtp = False
+        self.reset()
+
+    def reset(self):
+        self.mailfrom = None
+        self.rcpttos = []
+        self.message = None
+        self.pending_cr = b''
+
+    def discard_message(self):
+        if self.message is not None:
+            self.message.discard()
+        self.reset()
+
+    def push(self, line):
+        self.writer.write(line.encode('utf-8') + b'\r\n')
+
+    async def handle(self):
+        try:
+            await self.handle_commands()
+        finally:
+            self.discard_message()
+
+    async def handle_commands(self):
+        self.push('220 %s %s' % (self.fqdn, SmtpMailsinkServer.__version__))
+
+        while True:
+            # pipelined commands are already buffered in the reader, replies go out without waiting for the client
+            await self.writer.drain()
+            line = await self.reader.readline()
+
+            if not line:
+                return
+
+            line = line.rstrip(b'\r\n').decode('utf-8', errors='replace')
+            command, __, arg = line.partition(' ')
+            handler = getattr(self, 'smtp_' + command.upper(), None)
+
+            if not command:
+                self.push('500 Error: bad syntax')
+            elif handler is None:
+                self.push('500 Error: command "%s" not recognized' % command.upper())
+            elif await handler(arg.strip()) is False:
+                await self.writer.drain()
+                return
+
+    async def smtp_HELO(self, arg):
+        if not arg:
+            self.push('501 Syntax: HELO hostname')
+        elif self.seen_greeting:
+            self.push('503 Duplicate HELO/EHLO')
+        else:
+            self.seen_greeting = arg
+            self.push('250 %s' % self.fqdn)
+
+    async def smtp_EHLO(self, arg):
+        if not arg:
+            self.push('501 Syntax: EHLO hostname')
+        elif self.seen_greeting:
+            self.push('503 Duplicate HELO/EHLO')
+        else:
+            self.seen_greeting = arg
+            self.extended_smtp = True
+            self.push('250-%s' % self.fqdn)
+            self.push('250-SIZE %d' % DATA_SIZE_LIMIT)
+            self.push('250-8BITMIME')
+            self.push('250-PIPELINING')
+            self.push('250-CHUNKING')
+            self.push('250 HELP')
+
+    async def smtp_NOOP(self, arg):
+        self.push('250 OK')
+
+    async def smtp_QUIT(self, arg):
+        self.push('221 Bye')
+        return False
+
+    async def smtp_RSET(self, arg):
+        self.discard_message()
+        self.push('250 OK')
+
+    async def smtp_VRFY(self, arg):
+        self.push('252 Cannot VRFY user, but will accept message and attempt delivery')
+
+    async def smtp_MAIL(self, arg):
+        if not self.seen_greeting:
+            self.push('503 Error: send HELO first')
+            return
+
+        address, params = self.parse_path('FROM:', arg)
+
+        if address is None or (params and not self.extended_smtp):
+            self.push('501 Syntax: MAIL FROM:<address>')
+            return
+        if self.mailfrom is not None:
+            self.push('503 Error: nested MAIL command')
+            return
+
+        body = params.pop('BODY', '7BIT').upper()
+        size = params.pop('SIZE', '0')
+
+        if body not in ('7BIT', '8BITMIME'):
+            self.push('501 Error: BODY can only be one of 7BIT, 8BITMIME')
+        elif not size.isdigit():
+            self.push('501 Syntax: MAIL FROM:<address> SIZE=<number>')
+        elif int(size) > DATA_SIZE_LIMIT:
+            self.push('552 Error: message size exceeds fixed maximum message size')
+        elif params:
+            self.push('555 MAIL FROM parameters not recognized or not implemented')
+        elif not self.sink.admit_message():
+            self.push('452 Requested action not taken: ingest queue is full, try again later')
+        else:
+            self.mailfrom = address
+            self.push('250 OK')
+
+    async def smtp_RCPT(self, arg):
+        if self.mailfrom is None:
+            self.push('503 Error: need MAIL command')
+            return
+
+        address, params = self.parse_path('TO:', arg)
+
+        if not address:
+            self.push('501 Syntax: RCPT TO:<address>')
+        elif params:
+            self.push('555 RCPT TO parameters not recognized or not implemented')
+        else:
+            self.rcpttos.append(address)
+            self.push('250 OK')
+
+    async def smtp_DATA(self, arg):
+        if not self.rcpttos:
+            self.push('503 Error: need RCPT command')
+            return
+        if self.message is not None:
+            self.push('503 Error: DATA not allowed after BDAT')
+            return
+
+        self.push('354 End data with <CR><LF>.<CR><LF>')
+        await self.writer.drain()
+
+        self.message = self.sink.begin_message(self.peer, self.mailfrom, self.rcpttos)
+        # read in blocks rather than lines: up to each ".\r\n", which ends the data only at the start of a line,
+        # or up to the stream limit for big messages
+        data = bytearray()
+        at_line_start = True  # whether data starts a line
+
+        try:
+            while True:
+                try:
+                    data += await self.reader.readuntil(b'.\r\n')
+                except asyncio.LimitOverrunError as e:
+                    data += await self.reader.readexactly(e.consumed)
+                except asyncio.IncompleteReadError:
+                    self.discard_message()
+                    return False
+                else:
+                    dot = len(data) - 3
+                    if (data[dot - 1] == ord('\n')) if dot else at_line_start:
+                        del data[dot:]
+                        break
+
+                if len(data) >= COPY_CHUNK_SIZE:
+                    # written up to the last line break, so that neither a CRLF nor a stuffed dot gets cut
+                    cut = data.rfind(b'\n')
+                    if cut < 0:
+                        cut = len(data) - data.endswith(b'\r')
+                    elif data[cut - 1:cut] == b'\r':
+                        cut -= 1
+                    if cut:
+                        self.write_data(data[:cut], at_line_start)
+                        del data[:cut]
+                        at_line_start = False
+
+            # the line break before the terminating dot is not part of the message
+            self.write_data(data, at_line_start, is_last=True)
+        except BaseException:
+            self.discard_message()
+            raise
+
+        if self.message.size > DATA_SIZE_LIMIT:
+            self.discard_message()
+            self.push('552 Error: Too much mail data')
+        else:
+            self.deliver()
+
+    def write_data(self, data, at_line_start, is_last=False):
+        """
+        Removes the dots stuffed at line starts and normalizes CRLF to LF in a block of DATA
+        """
+        data = bytes(data).replace(b'\r\n', b'\n').replace(b'\n.', b'\n')
+        if at_line_start and data.startswith(b'.'):
+            data = data[1:]
+        if is_last and data.endswith(b'\n'):
+            data = data[:-1]
+        # keep reading up to the terminating dot even when over the limit, discarding the rest
+        if self.message.size <= DATA_SIZE_LIMIT:
+            self.message.write(data)
+
+    async def smtp_BDAT(self, arg):
+        args = arg.split()
+
+        if not 0 < len(args) < 3 or not args[0].isdigit() or (len(args) == 2 and args[1].upper() != 'LAST'):
+            # without a valid chunk size the rest of the stream cannot be parsed
+            self.push('501 Syntax: BDAT <chunk-size> [LAST]')
+            return False
+
+        chunk_size = int(args[0])
+        is_last = len(args) == 2
+        # the chunk has to be consumed even if the command is rejected
+        accepted = bool(self.rcpttos)
+
+        if accepted and self.message is None:
+            self.message = self.sink.begin_message(self.peer, self.mailfrom, self.rcpttos)
+
+        remaining = chunk_size
+
+        try:
+            while remaining:
+                data = await self.reader.read(min(remaining, COPY_CHUNK_SIZE))
+
+                if not data:
+                    raise asyncio.IncompleteReadError(data, remaining)
+                remaining -= len(data)
+
+                if accepted and self.message.size <= DATA_SIZE_LIMIT:
+                    # normalize CRLF to LF like DATA does, a CRLF may be split between two reads
+                    data = (self.pending_cr + data).replace(b'\r\n', b'\n')
+                    self.pending_cr = b'\r' if data.endswith(b'\r') else b''
+                    self.message.write(data[:-1] if self.pending_cr else data)
+        except BaseException:
+            self.discard_message()
+            raise
+
+        if not accepted:
+            self.push('503 Error: need RCPT command')
+        elif self.message.size > DATA_SIZE_LIMIT:
+            self.discard_message()
+            self.push('552 Error: Too much mail data')
+        elif is_last:
+            self.message.write(self.pending_cr)
+            self.deliver()
+        else:
+            self.push('250 %d bytes received' % chunk_size)
+
+    def deliver(self):
+        try:
+            status = self.sink.end_message(self.message)
+        except Exception as e:
+            LOG.error('Error processing message from %s', self.mailfrom, exc_info=e)
+            status = '451 Requested action aborted: local error in processing'
+
+        self.reset()
+        self.push(status or '250 OK')
+
+    @staticmethod
+    def parse_path(keyword, arg):
+        """
+        :return: (address, {ESMTP parameter: value}), address is None on syntax errors
+        """
+        if not arg[:len(keyword)].upper() == keyword:
+            return None, {}
+
+        address, __, params = arg[len(keyword):].strip().partition(' ')
+
+        if address.startswith('<') and address.endswith('>'):
+            address = address[1:-1]
+
+        esmtp_params = {}
+        for param in params.split():
+            name, __, value = param.partition('=')
+            esmtp_params[name.upper()] = value
+
+        return address, esmtp_params
+
+
+class AsyncioSmtpEngine:
+    """
+    asyncio engine: blocks in the event loop while idle, one task per client session
+    """
+    STREAM_LINE_LIMIT = 1024 * 1024  # tolerate clients exceeding the RFC 5321 line length
+
+    def __init__(self, sink, host, port, reuse_port=False):
+        self.sink = sink
+        self.socket = socket.create_server((host, port), reuse_port=reuse_port)
+        self.fqdn = socket.getfqdn()
+        self.loop = asyncio.new_event_loop()
+        self.sessions = {}
+        self._stopped = asyncio.Event()
+
+    def serve_forever(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._serve())
+        finally:
+            self.loop.close()
+
+    async def _serve(self):
+        server = await asyncio.start_server(self._on_connection, sock=self.socket, limit=self.STREAM_LINE_LIMIT)
+        await self._stopped.wait()
+
+        server.close()
+        # dropping the connections makes every session see EOF and finish on its own
+        for writer in self.sessions.values():
+            writer.transport.abort()
+        await asyncio.gather(*self.sessions, return_exceptions=True)
+        await server.wait_closed()
+
+    async def _on_connection(self, reader, writer):
+        session_task = asyncio.current_task()
+        self.sessions[session_task] = writer
+        try:
+            await AsyncioSmtpSession(self.sink, reader, writer, self.fqdn).handle()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError) as e:
+            LOG.debug('SMTP session aborted: %s', e)
+        finally:
+            self.sessions.pop(session_task, None)
+            writer.close()
+
+    def stop(self):
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._stopped.set)
+
+    def close(self):
+        self.socket.close()
+
+
+SMTP_ENGINES = {SMTP_ENGINE_ASYNCIO: AsyncioSmtpEngine}
+
+if importlib.util.find_spec('asyncore') and importlib.util.find_spec('smtpd'):
+    SMTP_ENGINES[SMTP_ENGINE_ASYNCORE] = create_asyncore_engine
+
+
+class PortAlreadyInUseException(Exception):
+    pass
+
+
+class SmtpMailsink(threading.Thread):
+
+    def __init__(self, host="localhost", port=DEFAULT_PORT, mailboxFilePath=None, threadName=None, mailQueue=None,
+                 engine=DEFAULT_SMTP_ENGINE, reuse_port=False, sink=None, highWaterMark=None, queueListener=None,
+                 durability=DEFAULT_MBOX_DURABILITY, commitMessages=DEFAULT_COMMIT_MESSAGES,
+                 commitMillisecs=DEFAULT_COMMIT_MILLISECS):
+        """
+        :param reuse_port: bind with SO_REUSEPORT, so that several processes can share the port
+        :param sink: a SmtpMailsinkServer to hand messages to instead of a default one writing to mailboxFilePath
+        :param highWaterMark: mailQueue depth at which new messages are deferred, None for no limit
+        :param queueListener: called from the SMTP thread whenever a message was put on mailQueue
+        :param durability: one of MBOX_DURABILITY_POLICIES, see MboxWriter
+        """
+        self.queue = mailQueue
+        self.mboxWriter = None
+        self.throwExceptionIfAddressIsInUse(host, port, reuse_port)
+        self.initializeThread(threadName)
+        self.initializeSmtpMailsinkServer(host, port, mailboxFilePath, engine, reuse_port, sink)
+        if sink is None:
+            self.mboxWriter = MboxWriter(mailboxFilePath, durability, commitMessages, commitMillisecs)
+            self.smtpMailsinkServer.set_mbox_writer(self.mboxWriter)
+        self.smtpMailsinkServer.set_high_water_mark(highWaterMark)
+        self.smtpMailsinkServer.set_queue_listener(queueListener)
+
+    def throwExceptionIfAddressIsInUse(self, host, port, reuse_port=False):
+        testSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        testSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,
+                              testSocket.getsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR) | 1)
+        if reuse_port:
+            testSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        try:
+            testSocket.bind((host, port))
+        except Exception as e:
+            raise PortAlreadyInUseException(e)
+        finally:
+            testSocket.close()
+
+    def initializeThread(self, threadName):
+        self.threadName = threadName
+        if self.threadName is None:
+            self.threadName = SmtpMailsink.__class__
+        threading.Thread.__init__(self, name=self.threadName)
+
+    def initializeSmtpMailsinkServer(self, host, port, mailboxFilePath, engine, reuse_port=False, sink=None):
+        if engine not in SMTP_ENGINES:
+            raise ValueError('SMTP engine %s is not available, expecting one of %s' % (engine, list(SMTP_ENGINES)))
+
+        self.smtpMailsinkServer = sink or SmtpMailsinkServer()
+        if sink is None:
+            self.smtpMailsinkServer.setQueue(self.queue)
+            self.init_mailbox(mailboxFilePath)
+        self.engine = SMTP_ENGINES[engine](self.smtpMailsinkServer, host, port, reuse_port=reuse_port)
+        LOG.info('SMTP engine: %s', engine)
+
+    def init_mailbox(self, mailboxFilePath=None):
+        self.mailboxFilePath = mailboxFilePath
+        #        if self.mailboxFilePath is None:
+        #            self.mailboxFilePath = StringIO.StringIO()
+        self.smtpMailsinkServer.set_mbox_file_path(self.mailboxFilePath)
+        if not os.path.exists(self.mailboxFilePath):
+            open(self.mailboxFilePath, 'ab').close()
+
+    def getMailboxContents(self):
+        return self.mailboxFilePath.getvalue()
+
+    def getMailboxFile(self):
+        return self.mailboxFilePath
+
+    def getAddress(self):
+        """
+        (host, port) actually bound, resolves port 0 to the ephemeral port picked by the OS
+        """
+        return self.engine.socket.getsockname()[:2]
+
+    def get_metrics(self):
+        return self.smtpMailsinkServer.get_metrics()
+
+    def start(self):
+        if self.mboxWriter is not None:
+            try:
+                self.mboxWriter.open()
+            except MailboxWriteException:
+                # the engine is already bound, it would keep the port until garbage collected
+                self.engine.close()
+                raise
+        threading.Thread.start(self)
+
+    def run(self):
+        self.engine.serve_forever()
+
+    def stop(self, timeout=None):
+        LOG.info("Stopping SMTP server...")
+        self.engine.stop()
+        threading.Thread.join(self, timeout)
+        self.engine.close()
+        if self.mboxWriter is not None:
+            self.mboxWriter.close()
+        LOG.info("Stopped.")
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
+
+
+class ForwardingMailsinkServer(SmtpMailsinkServer):
+    """
+    Runs inside a pool worker process: spools messages to files in a directory shared with the pool
+    and passes their paths on to the pool's single storage writer
+    """
+
+    def __init__(self, spool_dir, overloaded, deferred):
+        """
+        :param overloaded: multiprocessing.Event kept up to date by the pool writer
+        :param deferred: multiprocessing.Value counting deferrals across all workers
+        """
+        SmtpMailsinkServer.__init__(self)
+        self.spool_dir = spool_dir
+        self.overloaded = overloaded
+        self.deferred = deferred
+
+    def admit_message(self):
+        if self.overloaded.is_set():
+            with self.deferred.get_lock():
+                self.deferred.value += 1
+            return False
+        return True
+
+    def begin_message(self, peer, mailfrom, rcpttos):
+        spool_file = tempfile.NamedTemporaryFile(dir=self.spool_dir, suffix='.spool', delete=False)
+        return SpooledMessage(peer, mailfrom, rcpttos, spool_file, spool_file.name)
+
+    def end_message(self, message):
+        message.spool_file.close()
+        self.queue.put((message.peer, message.mailfrom, message.rcpttos, message.spool_path))
+
+
+def run_pool_worker(host, port, engine, results, spool_dir, overloaded, deferred, started, stop_requested,
+                    debug_smtp):
+    """
+    Entry point of a SmtpMailsinkPool worker process
+    """
+    global DEBUG_SMTP
+    DEBUG_SMTP = debug_smtp
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the pool owner decides when to stop
+
+    sink = ForwardingMailsinkServer(spool_dir, overloaded, deferred)
+    sink.setQueue(results)
+
+    with SmtpMailsink(host=host, port=port, engine=engine, reuse_port=True, sink=sink):
+        started.release()
+        stop_requested.wait()
+
+
+class SmtpMailsinkPool:
+    """
+    Runs N worker processes that all listen on the same port through SO_REUSEPORT, each with its own engine.
+    Their messages go through one queue to a single writer thread here, which owns the mbox file and the
+    mail queue, so appends are serialized and never interleave.
+
+    Has the same start()/stop()/is_alive() interface as SmtpMailsink.
+    """
+    WORKER_START_TIMEOUT_SECS = 30
+    OVERLOAD_CHECK_INTERVAL_SECS = 0.1
+
+    def __init__(self, host="localhost", port=DEFAULT_PORT, mailboxFilePath=None, mailQueue=None,
+                 engine=DEFAULT_SMTP_ENGINE, workers=2, highWaterMark=None, queueListener=None,
+                 durability=DEFAULT_MBOX_DURABILITY, commitMessages=DEFAULT_COMMIT_MESSAGES,
+                 commitMillisecs=DEFAULT_COMMIT_MILLISECS):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError('SO_REUSEPORT is not supported on this platform, cannot start SMTP worker processes')
+        if engine not in SMTP_ENGINES:
+            raise ValueError('SMTP engine %s is not available, expecting one of %s' % (engine, list(SMTP_ENGINES)))
+
+        # binding (without listening) reserves the port for the workers, and resolves port 0
+        self.reservedSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.reservedSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.reservedSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        try:
+            self.reservedSocket.bind((host, port))
+        except Exception as e:
+            self.reservedSocket.close()
+            raise PortAlreadyInUseException(e)
+
+        self.host, self.port = self.reservedSocket.getsockname()[:2]
+        self.engine = engine
+        self.workerCount = workers
+
+        self.smtpMailsinkServer = SmtpMailsinkServer()
+        self.smtpMailsinkServer.setQueue(mailQueue)
+        self.smtpMailsinkServer.set_mbox_file_path(mailboxFilePath)
+        self.smtpMailsinkServer.set_high_water_mark(highWaterMark)
+        self.smtpMailsinkServer.set_queue_listener(queueListener)
+        self.mboxWriter = None
+        if mailboxFilePath is not None:
+            self.mboxWriter = MboxWriter(mailboxFilePath, durability, commitMessages, commitMillisecs)
+            self.smtpMailsinkServer.set_mbox_writer(self.mboxWriter)
+
+        # spawn rather than fork: the parent may be a Qt app with running threads
+        self.context = multiprocessing.get_context('spawn')
+        self.results = self.context.Queue()
+        self.spoolDir = tempfile.mkdtemp(prefix='cutepiesmtp-spool-')
+        self.overloaded = self.context.Event()
+        self.deferred = self.context.Value('q', 0)
+        self.stopRequested = self.context.Event()
+        self.workers = []
+        self.writer = threading.Thread(target=self.write_results, name='SmtpMailsinkPool writer')
+
+    def write_results(self):
+        while True:
+            # wakes up regularly so that workers learn when the consumer caught up again
+            try:
+                item = self.results.get(timeout=self.OVERLOAD_CHECK_INTERVAL_SECS)
+            except queue.Empty:
+                item = ()
+            finally:
+                if self.smtpMailsinkServer.is_overloaded():
+                    self.overloaded.set()
+                else:
+                    self.overloaded.clear()
+
+            if item is None:
+                return
+            if not item:
+                continue
+
+            peer, mailfrom, rcpttos, spool_path = item
+
+            try:
+                message = SpooledMessage(peer, mailfrom, rcpttos, open(spool_path, 'rb'), spool_path)
+                self.smtpMailsinkServer.end_message(message)
+            except (OSError, MailboxWriteException) as e:
+                LOG.error('Message from %s is lost: %s', mailfrom, e)
+
+    def start(self):
+        started = self.context.Semaphore(0)
+        if self.mboxWriter is not None:
+            try:
+                self.mboxWriter.open()
+            except MailboxWriteException:
+                self.reservedSocket.close()
+                shutil.rmtree(self.spoolDir, ignore_errors=True)
+                raise
+        self.writer.start()
+
+        for __ in range(self.workerCount):
+            worker = self.context.Process(target=run_pool_worker,
+                                          args=(self.host, self.port, self.engine, self.results, self.spoolDir,
+                                                self.overloaded, self.deferred, started, self.stopRequested,
+                                                DEBUG_SMTP),
+                                          daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+        deadline = time() + self.WORKER_START_TIMEOUT_SECS
+
+        for __ in self.workers:
+            while not started.acquire(timeout=0.1):
+                if time() > deadline or not all(worker.is_alive() for worker in self.workers):
+                    self.stop()
+                    raise RuntimeError('SMTP worker processes failed to listen on port %d' % self.port)
+
+        LOG.info('SMTP engine: %s, %d worker processes', self.engine, self.workerCount)
+
+    def getAddress(self):
+        return self.host, self.port
+
+    def get_metrics(self):
+        metrics = self.smtpMailsinkServer.get_metrics()
+        metrics['deferred'] = self.deferred.value
+        try:
+            metrics['queue_depth'] += self.results.qsize()
+        except NotImplementedError:
+            pass  # OSX has no sem_getvalue()
+        return metrics
+
+    def is_alive(self):
+        return self.writer.is_alive()
+
+    def stop(self, timeout=None):
+        LOG.info("Stopping SMTP worker processes...")
+        self.stopRequested.set()
+
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+
+        # workers flush their queued messages before exiting, so the sentinel comes last
+        self.results.put(None)
+        self.writer.join(timeout)
+        if self.mboxWriter is not None:
+            self.mboxWriter.close()
+        self.reservedSocket.close()
+        shutil.rmtree(self.spoolDir, ignore_errors=True)
+        LOG.info("Stopped.")
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
+
+
+class MailboxWriteException(Exception):
+    pass
+
+
+class ScanCancelledException(Exception):
+    pass
+
+
+class MboxWriter:
+    """
+    Long-lived appender owned by the SMTP side: keeps the mbox open and group-commits the appends of all
+    sessions, every commit_messages messages or commit_millisecs after the oldest uncommitted one.
+    What a commit does is the durability policy: nothing (none), hand the buffer to the OS (flush),
+    or also wait for the disk (fsync).
+
+    Appends become readable right away whatever the policy: StoredMessage.read_chunks() and
+    flush_mbox_writes() flush the buffer on demand. mbox_write_file() calls for the same path are routed
+    through the open writer, so one-off appends from the GUI cannot interleave with buffered ones.
+    """
+
+    def __init__(self, mbox_path, durability=DEFAULT_MBOX_DURABILITY, commit_messages=DEFAULT_COMMIT_MESSAGES,
+                 commit_millisecs=DEFAULT_COMMIT_MILLISECS):
+        if durability not in MBOX_DURABILITY_POLICIES:
+            raise ValueError('Unknown mbox durability %s, expecting one of %s' % (durability, MBOX_DURABILITY_POLICIES))
+
+        self.mbox_path = mbox_path
+        self.durability = durability
+        self.commit_messages = max(1, commit_messages or 1)
+        self.commit_millisecs = commit_millisecs
+        self.mbox_file = None
+        self.index = None
+        self.flushed_offset = 0
+        self.pending = 0
+        self.commit_count = 0
+        self.closed = threading.Event()
+        self.committer = None
+        self.indexer = None
+
+    def open(self):
+        with MBOX_WRITE_LOCK:
+            key = os.path.realpath(self.mbox_path)
+            if key in MBOX_WRITERS:
+                raise MailboxWriteException('Mailbox %s is already open for writing' % self.mbox_path)
+            try:
+                self.mbox_file = open(self.mbox_path, 'ab')
+            except OSError as e:
+                raise MailboxWriteException('Cannot write to mailbox %s! Please, check if file is writable.'
+                                            % self.mbox_path) from e
+            # held until close(), so that other processes only read the mbox and leave its index alone
+            if not lock_mbox_file(self.mbox_file):
+                self.mbox_file.close()
+                self.mbox_file = None
+                raise MailboxWriteException('Mailbox %s is being written by another process' % self.mbox_path)
+            self.flushed_offset = self.mbox_file.tell()
+            self.closed.clear()
+            MBOX_WRITERS[key] = self
+
+        # capture must not wait for the index: until it is attached, readers just fall back to scanning the mbox
+        self.indexer = threading.Thread(target=self.attach_index, name='MboxWriter index', daemon=True)
+        self.indexer.start()
+
+        if self.durability != MBOX_DURABILITY_NONE and self.commit_millisecs:
+            self.committer = threading.Thread(target=self.commit_periodically, name='MboxWriter commit', daemon=True)
+            self.committer.start()
+
+    def attach_index(self):
+        """
+        Brings the index up to date with what is in the mbox without blocking appends, then, under
+        MBOX_WRITE_LOCK, indexes what was appended in the meantime and starts appending to it along with the mbox
+        """
+        index = MboxIndex(self.mbox_path)
+        try:
+            with mbox_index_lock(self.mbox_path, self.closed):
+                with MBOX_WRITE_LOCK:
+                    self.make_readable_locked()
+                    end = self.flushed_offset
+                index.sync(self.closed, end)
+
+                with MBOX_WRITE_LOCK:
+                    if self.mbox_file is None or self.closed.is_set():
+                        return
+                    self.make_readable_locked()
+                    index.open_for_append(self.closed, self.flushed_offset)
+                    self.index = index
+        except ScanCancelledException:
+            pass
+        except (OSError, ValueError) as e:
+            LOG.error('Cannot maintain mailbox index %s: %s', self.mbox_path + INDEX_SUFFIX, e)
+
+    def append_file(self, from_text, message_file):
+        """
+        :rtype: StoredMessage
+        """
+        with MBOX_WRITE_LOCK:
+            return self.append_locked(from_text, message_file)
+
+    def append_locked(self, from_text, message_file):
+        headers = read_index_headers(message_file)
+
+        try:
+            start = self.mbox_file.tell()
+            offset, length = mbox_write_record(self.mbox_file, from_text, message_file)
+            self.pending += 1
+        except Exception as e:
+            LOG.error('Error processing mail item!', exc_info=e)
+            raise MailboxWriteException('Cannot write to mailbox %s! Please, check if file is writable.'
+                                        % self.mbox_path) from e
+
+        stored_message = StoredMessage(self.mbox_path, offset, length, headers)
+
+        if self.index is not None:
+            try:
+                self.index.append(start, stored_message)
+            except OSError as e:
+                LOG.error('Cannot update mailbox index, it will be rebuilt: %s', e)
+                self.close_index()
+
+        if self.pending >= self.commit_messages:
+            self.commit_locked()
+
+        return stored_message
+
+    def commit(self):
+        with MBOX_WRITE_LOCK:
+            if self.pending and self.mbox_file is not None:
+                self.commit_locked()
+
+    def commit_locked(self):
+        if self.durability != MBOX_DURABILITY_NONE:
+            self.mbox_file.flush()
+            self.flushed_offset = self.mbox_file.tell()
+            if self.durability == MBOX_DURABILITY_FSYNC:
+                os.fsync(self.mbox_file.fileno())
+            # the index can always be rebuilt from the mbox, so it is never fsynced
+            self.flush_index()
+            self.commit_count += 1
+        self.pending = 0
+
+    def flush_index(self):
+        if self.index is not None:
+            try:
+                self.index.flush()
+            except OSError as e:
+                LOG.error('Cannot update mailbox index, it will be rebuilt: %s', e)
+                self.close_index()
+
+    def close_index(self):
+        index, self.index = self.index, None
+        try:
+            index.close()
+        except OSError:
+            pass
+
+    def commit_periodically(self):
+        while not self.closed.wait(self.commit_millisecs / 1000.0):
+            try:
+                self.commit()
+            except OSError as e:
+                LOG.error('Cannot commit mailbox %s: %s', self.mbox_path, e)
+
+    def make_readable(self, up_to=None):
+        """
+        Flushes buffered appends, unless everything before offset up_to already reached the OS
+        """
+        if up_to is not None and up_to <= self.flushed_offset:
+            return
+        with MBOX_WRITE_LOCK:
+            self.make_readable_locked()
+
+    def make_readable_locked(self):
+        if self.mbox_file is not None:
+            self.mbox_file.flush()
+            self.flushed_offset = self.mbox_file.tell()
+            self.flush_index()
+
+    def close(self):
+        self.closed.set()
+        if self.committer is not None:
+            self.committer.join()
+            self.committer = None
+        if self.indexer is not None:
+            self.indexer.join()
+            self.indexer = None
+
+        with MBOX_WRITE_LOCK:
+            if self.mbox_file is None:
+                return
+            try:
+                if self.pending:
+                    self.commit_locked()
+                self.mbox_file.close()
+                if self.index is not None:
+                    self.close_index()
+            finally:
+                self.mbox_file = None
+                MBOX_WRITERS.pop(os.path.realpath(self.mbox_path), None)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+
+def flush_mbox_writes(mbox_path, up_to=None):
+    """
+    Makes appends still buffered by an open MboxWriter visible to anyone reading mbox_path
+    """
+    writer = MBOX_WRITERS.get(os.path.realpath(mbox_path))
+    if writer is not None:
+        writer.make_readable(up_to)
+
+
+class MboxIndex:
+    """
+    Sidecar file next to an mbox, so that opening a mailbox needs neither to parse nor to read all of it.
+    A version line, then one JSON line per message: [start of its "From " line, offset, length, raw INDEX_HEADERS].
+
+    The MboxWriter appends to it along with the mbox. Anything appended to the mbox behind its back is picked up
+    by scanning from the last indexed message on, and an index that does not match its mbox is rebuilt.
+    """
+
+    def __init__(self, mbox_path):
+        self.mbox_path = mbox_path
+        self.index_path = mbox_path + INDEX_SUFFIX
+        self.index_file = None
+
+    def header_line(self):
+        return json.dumps({'version': INDEX_VERSION}) + '\n'
+
+    def load(self, cancel=None):
+        """
+        Brings the index up to date with the mbox and returns all its messages. Whatever the index does not
+        have yet, e.g. while another process writes the mbox, is found by scanning after its last entry.
+        :param cancel: threading.Event, raises ScanCancelledException once set
+        :rtype: list of StoredMessage
+        """
+        try:
+            self.sync(cancel)
+        except OSError as e:
+            # e.g. a read-only folder: the messages are still there, only slower to find
+            LOG.error('Cannot update mailbox index %s: %s', self.index_path, e)
+
+        entries = self.read_entries() or []
+        # the writer of another process may have flushed index entries before their messages
+        size = os.path.getsize(self.mbox_path)
+        while entries and entries[-1][1] + entries[-1][2] > size:
+            entries.pop()
+        if entries and not self.is_valid_entry(entries[-1]):
+            entries = []  # left for the process writing the mbox to rebuild
+        position = entries[-1][1] + entries[-1][2] if entries else 0
+        entries.extend(scan_settled_mbox(self.mbox_path, position, cancel))
+
+        return [self.to_stored_message(entry) for entry in entries]
+
+    def open_for_append(self, cancel=None, end=None):
+        self.sync(cancel, end)
+        self.index_file = open(self.index_path, 'a', encoding='utf-8')
+
+    def append(self, start, stored_message):
+        self.index_file.write(self.entry_line(start, stored_message.offset, stored_message.length,
+                                              stored_message.headers))
+
+    def flush(self):
+        if self.index_file is not None:
+            self.index_file.flush()
+
+    def close(self):
+        if self.index_file is not None:
+            self.index_file.close()
+            self.index_file = None
+
+    def sync(self, cancel=None, end=None):
+        """
+        Validates the index against the mbox, rebuilds it when it does not match and indexes unindexed messages.
+        One sync at a time per mbox, in any process: two of them would write the same entries twice.
+        Only the MboxWriter writes the index of an mbox it has open, anyone else leaves it alone meanwhile
+        and never indexes a last message which may still be being written.
+        :param cancel: threading.Event, raises ScanCancelledException once set
+        :param end: given by the MboxWriter only, offset up to which the mbox holds whole messages
+        """
+        with mbox_index_lock(self.mbox_path, cancel):
+            if end is None and self.is_written_by_others():
+                return
+
+            last_entry, valid_size = self.read_last_entry()
+            is_rebuilt = last_entry is None or not self.is_valid_entry(last_entry)
+            position = 0 if is_rebuilt else last_entry[1] + last_entry[2]
+
+            if end is None:
+                entries = scan_settled_mbox(self.mbox_path, position, cancel)
+            else:
+                entries = list(scan_mbox_parallel(self.mbox_path, position, end=end, cancel=cancel))
+
+            if is_rebuilt:
+                LOG.info('Indexing mailbox %s', self.mbox_path)
+                with open(self.index_path, 'w', encoding='utf-8') as index_file:
+                    index_file.write(self.header_line())
+                    index_file.writelines(self.entry_line(*entry) for entry in entries)
+                return
+
+            with open(self.index_path, 'r+', encoding='utf-8') as index_file:
+                # drops a last line cut short by a crash
+                index_file.truncate(valid_size)
+                index_file.seek(valid_size)
+                index_file.writelines(self.entry_line(*entry) for entry in entries)
+
+    def is_written_by_others(self):
+        writer = MBOX_WRITERS.get(os.path.realpath(self.mbox_path))
+        if writer is not None:
+            return writer.index is not self
+        return is_mbox_written_elsewhere(self.mbox_path)
+
+    def read_entries(self):
+        """
+        :return: list of [start, offset, length, headers], None if there is no usable index
+        """
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as index_file:
+                if not self.is_valid_header(index_file.readline()):
+                    return None
+                entries = []
+                for line in index_file:
+                    if not line.endswith('\n'):
+                        break  # still being written
+                    entries.append(json.loads(line))
+                return entries
+        except (OSError, ValueError):
+            return None
+
+    def read_last_entry(self):
+        """
+        Reads backwards from the end, so that validating a huge index stays cheap
+        :return: (last entry or None, size of the index up to its last complete line or None if unusable)
+        """
+        try:
+            with open(self.index_path, 'rb') as index_file:
+                if not self.is_valid_header(index_file.readline().decode('utf-8', errors='replace')):
+                    return None, None
+                header_size = index_file.tell()
+
+                end = index_file.seek(0, os.SEEK_END)
+                tail = b''
+                while end > header_size:
+                    start = max(header_size, end - COPY_CHUNK_SIZE)
+                    index_file.seek(start)
+                    tail = index_file.read(end - start) + tail
+                    end = start
+                    lines = tail.split(b'\n')
+                    # lines[-1] is whatever follows the last newline, incomplete unless empty
+                    if len(lines) > 2 or (end == header_size and len(lines) > 1):
+                        valid_size = index_file.seek(0, os.SEEK_END) - len(lines[-1])
+                        return json.loads(lines[-2].decode('utf-8')), valid_size
+                return None, header_size
+        except (OSError, ValueError):
+            return None, None
+
+    def is_valid_header(self, line):
+        try:
+            return json.loads(line).get('version') == INDEX_VERSION
+        except (ValueError, AttributeError):
+            return False
+
+    def is_valid_entry(self, entry):
+        """
+        Checks that the entry still points at a "From " line within the mbox
+        """
+        try:
+            start, offset, length, __ = entry
+            with open(self.mbox_path, 'rb') as mbox_file:
+                if mbox_file.seek(0, os.SEEK_END) < offset + length:
+                    return False
+                mbox_file.seek(start)
+                return mbox_file.read(5) == b'From '
+        except (OSError, ValueError, TypeError):
+            return False
+
+    def entry_line(self, start, offset, length, headers):
+        return json.dumps([start, offset, length, headers], ensure_ascii=False) + '\n'
+
+    def to_stored_message(self, entry):
+        start, offset, length, headers = entry
+        return StoredMessage(self.mbox_path, offset, length, headers)
+
+
+class MboxIndexLock:
+    """
+    Serializes the index syncs of one mbox: between threads with a reentrant lock, and between processes
+    with flock() on the index, taken by the outermost holder
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.lock_file = None
+
+    def acquire(self, cancel=None):
+        while not self.lock.acquire(timeout=SCAN_CANCEL_POLL_SECS):
+            if cancel is not None and cancel.is_set():
+                raise ScanCancelledException('Indexing %s cancelled' % self.index_path)
+
+        if self.depth == 0 and fcntl is not None:
+            try:
+                lock_file = open(self.index_path, 'ab')
+            except OSError:
+                self.lock.release()
+                raise
+            try:
+                flock_polling(lock_file, fcntl.LOCK_EX, cancel)
+            except BaseException:
+                lock_file.close()
+                self.lock.release()
+                raise
+            self.lock_file = lock_file
+        self.depth += 1
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0 and self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+        self.lock.release()
+
+
+@contextlib.contextmanager
+def mbox_index_lock(mbox_path, cancel=None):
+    """
+    Holds the MboxIndexLock of mbox_path, giving up on waiting for it once cancel is set
+    """
+    with MBOX_INDEX_LOCKS_LOCK:
+        key = os.path.realpath(mbox_path)
+        lock = MBOX_INDEX_LOCKS.get(key)
+        if lock is None:
+            lock = MBOX_INDEX_LOCKS[key] = MboxIndexLock(mbox_path + INDEX_SUFFIX)
+
+    lock.acquire(cancel)
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def flock_polling(lock_file, operation, cancel=None, timeout=None):
+    """
+    flock() that gives up waiting once cancel is set (raising ScanCancelledException) or after timeout seconds
+    :return: False if it timed out
+    """
+    deadline = None if timeout is None else time() + timeout
+    while True:
+        try:
+            fcntl.flock(lock_file.fileno(), operation | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            pass
+        if cancel is not None and cancel.is_set():
+            raise ScanCancelledException('Waiting for %s cancelled' % lock_file.name)
+        if deadline is not None and time() > deadline:
+            return False
+        sleep(MBOX_LOCK_POLL_SECS)
+
+
+def lock_mbox_file(mbox_file):
+    """
+    Marks an mbox open for appending as being written, see is_mbox_written_elsewhere(). Closing the file unlocks it.
+    :return: False if another process is writing it
+    """
+    return fcntl is None or flock_polling(mbox_file, fcntl.LOCK_EX, timeout=MBOX_LOCK_TIMEOUT_SECS)
+
+
+def is_mbox_written_elsewhere(mbox_path):
+    """
+    Whether another process has mbox_path open for appending, e.g. a headless mail sink
+    """
+    if fcntl is None or os.path.realpath(mbox_path) in MBOX_WRITERS:
+        return False
+    try:
+        with open(mbox_path, 'rb') as mbox_file:
+            try:
+                fcntl.flock(mbox_file.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            return False
+    except OSError:
+        return False
+
+
+def scan_settled_mbox(mbox_path, position=0, cancel=None):
+    """
+    scan_mbox_parallel() for readers: leaves out the last message while it may still be being written,
+    see is_last_message_settled()
+    :return: list of (start, offset, length, raw INDEX_HEADERS)
+    """
+    size = os.path.getsize(mbox_path)
+    entries = list(scan_mbox_parallel(mbox_path, position, end=size, cancel=cancel))
+    if entries and not is_last_message_settled(mbox_path, entries[-1], size):
+        entries.pop()
+    return entries
+
+
+def is_last_message_settled(mbox_path, entry, size):
+    """
+    Whether the last message scanned from the first size bytes of an mbox is whole: the mbox did not grow since,
+    and either no other process writes it or its writer already indexed the message
+    :param entry: (start, offset, length, raw INDEX_HEADERS) from scan_mbox()
+    """
+    if os.path.getsize(mbox_path) != size:
+        return False
+    if not is_mbox_written_elsewhere(mbox_path):
+        return True
+    # the writer flushes its index after the messages, see MboxWriter.commit_locked()
+    last_entry, __ = MboxIndex(mbox_path).read_last_entry()
+    return last_entry is not None and list(last_entry[:3]) == list(entry[:3])
+
+
+def load_mbox_index(mbox_path, cancel=None):
+    """
+    Lists the messages of an mbox from its index
+    :param cancel: threading.Event, raises ScanCancelledException once set
+    :rtype: list of StoredMessage
+    """
+    with MBOX_WRITE_LOCK:
+        writer = MBOX_WRITERS.get(os.path.realpath(mbox_path))
+        if writer is not None:
+            # the open writer keeps the index in sync, it only has to be flushed
+            writer.make_readable_locked()
+            index_is_maintained = writer.index is not None
+        else:
+            index_is_maintained = False
+
+    if index_is_maintained:
+        index = MboxIndex(mbox_path)
+        return [index.to_stored_message(entry) for entry in index.read_entries() or []]
+    if writer is not None:
+        return [StoredMessage(mbox_path, offset, length, headers)
+                for __, offset, length, headers in scan_mbox_parallel(mbox_path, cancel=cancel)]
+    return MboxIndex(mbox_path).load(cancel)
+
+
+def scan_mbox_parallel(mbox_path, position=0, workers=None, end=None, cancel=None):
+    """
+    Same as scan_mbox(), but a large mbox is split at message boundaries into one byte range per worker process,
+    whose results are merged back in mbox order
+    :param workers: number of processes, defaults to the number of CPUs
+    :param end: see scan_mbox()
+    :param cancel: threading.Event, raises ScanCancelledException once set
+    """
+    workers = workers or os.cpu_count() or 1
+    size = os.path.getsize(mbox_path) if end is None else end
+
+    if workers < 2 or size - position < PARALLEL_SCAN_MIN_BYTES:
+        yield from scan_mbox(mbox_path, position, end, cancel)
+        return
+
+    splits = find_mbox_boundaries(mbox_path, position, size, workers)
+
+    # spawn rather than fork: the GUI has running threads
+    executor = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        futures = [executor.submit(scan_mbox_range, mbox_path, start, end) for start, end in zip(splits, splits[1:])]
+        for future in futures:
+            while True:
+                if cancel is not None and cancel.is_set():
+                    raise ScanCancelledException('Scanning %s cancelled' % mbox_path)
+                try:
+                    entries = future.result(timeout=SCAN_CANCEL_POLL_SECS)
+                    break
+                except concurrent.futures.TimeoutError:
+                    pass
+            yield from entries
+    finally:
+        # a cancelled scan does not wait for the ranges being scanned, their workers exit once done
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def find_mbox_boundaries(mbox_path, position, end, parts):
+    """
+    Splits [position, end) into about equal byte ranges that each start with a message
+    :return: sorted offsets, starting with position and ending with end
+    """
+    splits = [position]
+
+    with open_mbox_map(mbox_path) as mbox_map:
+        for part in range(1, parts):
+            target = max(splits[-1], position + (end - position) * part // parts)
+            found = mbox_map.find(MBOX_SEPARATOR, max(target - 2, position), end)
+            if found < 0:
+                break
+            if found + 2 > splits[-1]:
+                splits.append(found + 2)
+
+    splits.append(end)
+    return splits
+
+
+def scan_mbox_range(mbox_path, start, end):
+    """
+    Runs in a scan_mbox_parallel() worker process
+    """
+    return list(scan_mbox(mbox_path, start, end))
+
+
+@contextlib.contextmanager
+def open_mbox_map(mbox_path):
+    """
+    Read-only mmap of the mbox, an empty file cannot be mapped and gives empty bytes
+    """
+    with open(mbox_path, 'rb') as mbox_file:
+        if os.fstat(mbox_file.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(mbox_file.fileno(), 0, access=mmap.ACCESS_READ) as mbox_map:
+            yield mbox_map
+
+
+def iter_mbox_boundaries(mbox_map, position=0, end=None):
+    """
+    Finds where the "From " lines of the messages start, with bytes searches over the mapped mbox
+    :return: generator of offsets
+    """
+    end = len(mbox_map) if end is None else end
+
+    if mbox_map[position:position + 5] == b'From ' and (position == 0 or mbox_map[position - 2:position] == b'\n\n'):
+        yield position
+
+    found = mbox_map.find(MBOX_SEPARATOR, position, end)
+    while found >= 0:
+        yield found + 2
+        found = mbox_map.find(MBOX_SEPARATOR, found + 2, end)
+
+
+def count_mbox_messages(mbox_path):
+    with open_mbox_map(mbox_path) as mbox_map:
+        return sum(1 for __ in iter_mbox_boundaries(mbox_map))
+
+
+def scan_mbox(mbox_path, position=0, end=None, cancel=None):
+    """
+    Finds the messages in an mbox from position on, see iter_mbox_boundaries()
+    :param end: stop at this offset, which has to be the start of a message or the end of the file
+    :param cancel: threading.Event, raises ScanCancelledException once set
+    :return: generator of (start, offset, length, raw INDEX_HEADERS)
+    """
+    with open_mbox_map(mbox_path) as mbox_map:
+        end = len(mbox_map) if end is None else end
+        start = None
+
+        for boundary in iter_mbox_boundaries(mbox_map, position, end):
+            if cancel is not None and cancel.is_set():
+                raise ScanCancelledException('Scanning %s cancelled' % mbox_path)
+            if start is not None:
+                # the separating empty line is not part of the message, see mbox_write_record()
+                yield scanned_message(mbox_map, start, boundary - 2)
+            start = boundary
+
+        if start is not None:
+            message_end = end - 2 if mbox_map[end - 2:end] == b'\n\n' else end
+            yield scanned_message(mbox_map, start, message_end)
+
+
+def scanned_message(mbox_map, start, end):
+    offset = mbox_map.find(b'\n', start, end) + 1 or end
+    end = max(offset, end)
+    header_end = mbox_map.find(b'\n\n', offset, min(end, offset + HEADER_BLOCK_LIMIT))
+    if header_end < 0:
+        header_end = min(end, offset + HEADER_BLOCK_LIMIT)
+    return start, offset, end - offset, parse_index_headers(mbox_map[offset:header_end])
+
+
+def transform_line_starts(chunks, transformation):
+    """
+    Applies ESCAPE_FROM_LINE or UNESCAPE_FROM_LINE to the start of every line, across chunk boundaries
+    :return: generator of transformed chunks
+    """
+    pattern, replacement = transformation
+    carry = b''
+    at_line_start = True
+
+    for chunk in chunks:
+        # a newline in front lets the pattern match the first line too
+        prefix = b'\n' if at_line_start else b''
+        data = prefix + carry + chunk
+
+        # a last line that may still turn into a "From " line waits for the next chunk
+        tail_start = data.rfind(b'\n') + 1
+        tail = data[tail_start:].lstrip(b'>')
+        if tail_start and len(tail) < 5 and b'From '.startswith(tail):
+            carry = data[tail_start:]
+            data = data[:tail_start]
+            at_line_start = True
+        else:
+            carry = b''
+            at_line_start = False
+
+        data = pattern.sub(replacement, data)[len(prefix):]
+        if data:
+            yield data
+
+    if carry:
+        yield carry
+
+
+def read_index_headers(message_file):
+    """
+    Reads the INDEX_HEADERS of a message file, leaving its position unchanged
+    """
+    position = message_file.tell()
+    block = read_header_block(iter(lambda: message_file.read(HEADER_READ_SIZE), b''))
+    message_file.seek(position)
+    return parse_index_headers(block)
+
+
+def read_header_block(chunks):
+    """
+    Reads chunks only until the empty line ending the headers, the body is never looked at
+    :return: the headers, at most HEADER_BLOCK_LIMIT bytes of them
+    """
+    block = b''
+
+    for chunk in chunks:
+        # the separator may straddle two chunks
+        search_from = max(0, len(block) - 3)
+        block += chunk
+        for separator in (b'\n\n', b'\r\n\r\n'):
+            end = block.find(separator, search_from)
+            if end >= 0:
+                return block[:end]
+        if len(block) >= HEADER_BLOCK_LIMIT:
+            return block[:HEADER_BLOCK_LIMIT]
+
+    return block
+
+
+def parse_index_headers(block):
+    """
+    :param block: start of a raw message, the header part is used
+    :return: dict of raw INDEX_HEADERS values, unfolded
+    """
+    for separator in (b'\n\n', b'\r\n\r\n'):
+        end = block.find(separator)
+        if end >= 0:
+            block = block[:end]
+            break
+
+    headers = {}
+    # a regular expression over the whole block is much cheaper than email.parser for a handful of headers
+    for match in INDEX_HEADER_LINE.finditer(block):
+        name = INDEX_HEADER_NAMES[match.group(1).lower()]
+        if name not in headers:  # the first one wins, like Message.get()
+            headers[name] = match.group(2).decode('utf-8', errors='replace').replace('\r', '').replace('\n', '').strip()
+    return headers
+
+
+def mbox_write_item(mbox_path, from_text, data):
+    """
+    :param data: raw message bytes, written as they are
+    :rtype: StoredMessage
+    """
+    if DEBUG_APP:
+        LOG.debug(data)
+
+    return mbox_write_file(mbox_path, from_text, io.BytesIO(data))
+
+
+def mbox_write_file(mbox_path, from_text, message_file):
+    """
+    Appends a message read from a binary file object in chunks, never holding all of it in memory
+    :rtype: StoredMessage
+    """
+    with MBOX_WRITE_LOCK:
+        writer = MBOX_WRITERS.get(os.path.realpath(mbox_path))
+        if writer is not None:
+            return writer.append_locked(from_text, message_file)
+
+        try:
+            with open(mbox_path, 'ab') as mbox_file:
+                if not lock_mbox_file(mbox_file):
+                    raise MailboxWriteException('Mailbox %s is being written by another process' % mbox_path)
+                offset, length = mbox_write_record(mbox_file, from_text, message_file)
+        except MailboxWriteException:
+            raise
+        except Exception as e:
+            LOG.error('Error processing mail item!', exc_info=e)
+            raise MailboxWriteException('Cannot write to mailbox %s! Please, check if file is writable.'
+                                        % mbox_path) from e
+
+    return StoredMessage(mbox_path, offset, length)
+
+
+def mbox_write_record(mbox_file, from_text, message_file):
+    """
+    :return: (offset, length) of the message within the mbox
+    """
+    mbox_file.write(b"From %s\n" % from_text.encode('utf-8', errors='replace'))
+    offset = mbox_file.tell()
+    for chunk in transform_line_starts(iter(lambda: message_file.read(COPY_CHUNK_SIZE), b''), ESCAPE_FROM_LINE):
+        mbox_file.write(chunk)
+    length = mbox_file.tell() - offset
+    mbox_file.write(b"\n\n")
+    LOG.debug('From: %s', from_text)
+    return offset, length
+
+
+def init_logging(log_file_dir=None, log_to_stdout=True, log_to_file=False):
+    LOG.setLevel(logging.DEBUG)
+
+    if log_to_stdout or log_to_file:
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    else:
+        return
+
+    if log_to_file:
+        if not log_file_dir:
+            log_file_dir = '.'
+
+        log_file_path = os.path.join(log_file_dir, LOG_FILE_NAME)
+        print('Logging to file', log_file_path)
+        file_handler = logging.FileHandler(log_file_path)
+        file_handler.setLevel(logging.DEBUG)
+        file_handler.setFormatter(formatter)
+        LOG.addHandler(file_handler)
+
+    if log_to_stdout:
+        stdout_handler = logging.StreamHandler()
+        stdout_handler.setLevel(logging.DEBUG)
+        stdout_handler.setFormatter(formatter)
+        LOG.addHandler(stdout_handler)
+
+
+def format_metrics(metrics):
+    return 'queued %d/%s, accepted %d, deferred %d' % (metrics['queue_depth'], metrics['high_water_mark'] or 'unlimited',
+                                                       metrics['accepted'], metrics['deferred'])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Headless Cute Pie SMTP Daemon: '
+                                                 'captures incoming mail into an mbox file, without the GUI')
+    parser.add_argument('--host', default='127.0.0.1', help='interface to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='SMTP port, 0 picks a free one (default: %(default)s)')
+    parser.add_argument('--mbox', default=DEFAULT_MBOX_PATH, help='mailbox file to append to (default: %(default)s)')
+    parser.add_argument('--engine', default=DEFAULT_SMTP_ENGINE, choices=sorted(SMTP_ENGINES),
+                        help='SMTP engine (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='listener processes sharing the port through SO_REUSEPORT (default: %(default)s)')
+    parser.add_argument('--durability', default=DEFAULT_MBOX_DURABILITY, choices=MBOX_DURABILITY_POLICIES,
+                        help='what each mbox group commit does: nothing, flush to the OS or fsync '
+                             '(default: %(default)s)')
+    parser.add_argument('--commit-messages', type=int, default=DEFAULT_COMMIT_MESSAGES,
+                        help='group commit after this many messages (default: %(default)s)')
+    parser.add_argument('--commit-ms', type=int, default=DEFAULT_COMMIT_MILLISECS,
+                        help='group commit at most this many milliseconds after a message, 0 disables '
+                             '(default: %(default)s)')
+    parser.add_argument('--metrics-interval', type=float, default=0,
+                        help='log ingest metrics every N seconds, 0 disables (default: %(default)s)')
+    parser.add_argument('--quiet', action='store_true', help='log errors only')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Runs the mail sink until SIGINT/SIGTERM. Once listening, prints "smtp@host:port ON" to stdout,
+    which is what a test harness launching this as a subprocess should wait for.
+    """
+    global DEBUG_SMTP
+
+    # the SMTP worker pool and parallel scans spawn processes, which a frozen executable has to recognize
+    multiprocessing.freeze_support()
+    args = parse_args(argv)
+    DEBUG_SMTP = False
+    init_logging()
+    LOG.setLevel(logging.ERROR if args.quiet else logging.INFO)
+
+    try:
+        if args.workers > 1:
+            mailsink = SmtpMailsinkPool(host=args.host, port=args.port, mailboxFilePath=args.mbox, engine=args.engine,
+                                        workers=args.workers, durability=args.durability,
+                                        commitMessages=args.commit_messages, commitMillisecs=args.commit_ms)
+        else:
+            mailsink = SmtpMailsink(host=args.host, port=args.port, mailboxFilePath=args.mbox, engine=args.engine,
+                                    durability=args.durability, commitMessages=args.commit_messages,
+                                    commitMillisecs=args.commit_ms)
+        mailsink.start()
+    except PortAlreadyInUseException as e:
+        LOG.error('SMTP port %d is already in use: %s', args.port, e)
+        return 1
+    except (OSError, ValueError, RuntimeError, MailboxWriteException) as e:
+        LOG.error('Cannot start the mail sink on %s: %s', args.mbox, e)
+        return 1
+
+    stop_requested = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *__: stop_requested.set())
+
+    try:
+        print('smtp@%s:%d ON' % mailsink.getAddress(), flush=True)
+
+        while not stop_requested.wait(args.metrics_interval or None):
+            LOG.info('Ingest metrics: %s', format_metrics(mailsink.get_metrics()))
+    finally:
+        mailsink.stop()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())